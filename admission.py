@@ -0,0 +1,70 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+# Each user may start QUEST_USER_BURST quests at once, refilling at QUEST_USER_RATE per second
+QUEST_USER_RATE = float(os.getenv('QUEST_USER_RATE', '0.1'))
+QUEST_USER_BURST = float(os.getenv('QUEST_USER_BURST', '3'))
+# Generated quests allowed in flight across all users before new ones are shed
+QUEST_MAX_IN_FLIGHT = int(os.getenv('QUEST_MAX_IN_FLIGHT', '32'))
+# Users whose buckets are remembered; anyone older starts again with a full bucket
+ADMISSION_MAX_USERS = int(os.getenv('ADMISSION_MAX_USERS', '10000'))
+
+ADMITTED = "admitted"
+RATE_LIMITED = "rate_limited"
+SATURATED = "saturated"
+
+
+class AdmissionControl:
+    """Per-user token buckets plus a global in-flight cap for expensive requests.
+
+    admit() never waits: it either lets a request through, counting it as in flight until
+    release(), or says why it was shed so the caller can answer cheaply instead.
+    """
+
+    def __init__(self, user_rate: float = QUEST_USER_RATE, user_burst: float = QUEST_USER_BURST,
+                 max_in_flight: int = QUEST_MAX_IN_FLIGHT, max_users: int = ADMISSION_MAX_USERS):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_in_flight = max_in_flight
+        self.max_users = max_users
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = {RATE_LIMITED: 0, SATURATED: 0}
+        self._buckets = OrderedDict()
+
+    def _take_token(self, key: Hashable) -> bool:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.user_burst, now))
+        tokens = min(self.user_burst, tokens + (now - updated) * self.user_rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def admit(self, key: Hashable) -> str:
+        """ADMITTED (call release() when done), RATE_LIMITED or SATURATED."""
+        if self.in_flight >= self.max_in_flight:
+            decision = SATURATED
+        elif not self._take_token(key):
+            decision = RATE_LIMITED
+        else:
+            self.in_flight += 1
+            self.admitted += 1
+            return ADMITTED
+        self.shed[decision] += 1
+        return decision
+
+    def release(self):
+        self.in_flight -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"admitted": self.admitted, "in_flight": self.in_flight, **self.shed}
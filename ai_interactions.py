@@ -1,17 +1,191 @@
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
+import asyncio
 import os
+import random
 import logging
-from typing import Optional
+import httpx
+from contextlib import contextmanager
+from typing import AsyncIterator, List, Optional
+from collections import deque
+from coalescer import Coalescer
+from circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED
+from metrics import OPENAI_DURATION, OPENAI_TOKENS
+from quest_templates import generate_slips
 
 logger = logging.getLogger(__name__)
 
+# Shared HTTP pool, per-call timeout and concurrency limit for OpenAI requests
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '16'))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', str(OPENAI_MAX_CONCURRENCY)))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '20'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+# Identical permission slip requests arriving within this window share one completion
+OPENAI_COALESCE_WINDOW = float(os.getenv('OPENAI_COALESCE_WINDOW', '0.05'))
+OPENAI_COALESCE_MAX_BATCH = int(os.getenv('OPENAI_COALESCE_MAX_BATCH', '8'))
+# Stop calling OpenAI after this many consecutive failures or slow calls, and retry after the reset time
+OPENAI_BREAKER_FAILURES = int(os.getenv('OPENAI_BREAKER_FAILURES', '5'))
+OPENAI_BREAKER_SLOW_CALL = float(os.getenv('OPENAI_BREAKER_SLOW_CALL', '10'))
+OPENAI_BREAKER_RESET = float(os.getenv('OPENAI_BREAKER_RESET', '30'))
+# Send a second copy of a completion that's slower than the recent p95 (OPENAI_HEDGE_DELAY until
+# there's enough history); doubles the cost of the slowest requests, so it's off by default
+OPENAI_HEDGE = os.getenv('OPENAI_HEDGE', '').lower() in ('1', 'true', 'yes')
+OPENAI_HEDGE_DELAY = float(os.getenv('OPENAI_HEDGE_DELAY', '3'))
+
+FALLBACK_DAILY_MESSAGE = ("🌅 DAILY AFFIRMATION:\n"
+                          "I am capable of creating beautiful moments and meaningful connections in my life.\n\n"
+                          "🎯 TODAY'S QUEST:\n"
+                          "Share a genuine compliment with three different people today, focusing on their actions or character rather than appearances.")
+
 class AIInteractions:
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        
-    def generate_permission_slip(self, user_feeling: Optional[str] = None) -> str:
-        """Generate a personalized affirmation and quest."""
-        
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                                max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+            timeout=OPENAI_TIMEOUT
+        )
+        # Retries are handled in _complete so they can be jittered and counted against the semaphore
+        self.client = AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            http_client=self.http_client,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=0
+        )
+        self._semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+        self.coalescer = Coalescer(OPENAI_COALESCE_WINDOW, OPENAI_COALESCE_MAX_BATCH)
+        self._streaming = {}
+        self.breaker = CircuitBreaker("OpenAI", OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_SLOW_CALL, OPENAI_BREAKER_RESET)
+        self.hedges = 0
+        self._latencies = deque(maxlen=200)
+
+    async def close(self):
+        """Close the shared HTTP connection pool."""
+        await self.client.close()
+
+    def _is_retryable(self, error: Exception) -> bool:
+        """Timeouts, connection errors, rate limits and 5xx responses are worth retrying."""
+        if isinstance(error, (APIConnectionError, RateLimitError)):
+            return True
+        return isinstance(error, APIStatusError) and error.status_code >= 500
+
+    async def _create(self, system_prompt: str, user_prompt: str, mood: Optional[str] = None, **kwargs):
+        """Make one chat completion request, reporting its outcome to the circuit breaker and metrics."""
+        loop = asyncio.get_running_loop()
+        labels = {"mood": mood or "none", "stream": str(bool(kwargs.get("stream"))).lower()}
+        started = loop.time()
+        try:
+            response = await self.client.chat.completions.create(
+                model="gpt-4.1-nano",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.8,
+                max_tokens=300,
+                **kwargs
+            )
+        except Exception as e:
+            if self._is_retryable(e):
+                self.breaker.record_failure()
+            OPENAI_DURATION.observe(loop.time() - started, outcome="error", **labels)
+            raise
+        elapsed = loop.time() - started
+        self.breaker.record_success(elapsed)
+        if not kwargs.get("stream"):
+            # A stream returns once it opens, long before the completion is done, so its
+            # latency would drag the hedge delay down
+            self._latencies.append(elapsed)
+        OPENAI_DURATION.observe(elapsed, outcome="ok", **labels)
+        # Streamed responses don't report usage
+        usage = getattr(response, "usage", None)
+        if usage:
+            OPENAI_TOKENS.inc(usage.prompt_tokens, mood=labels["mood"], type="prompt")
+            OPENAI_TOKENS.inc(usage.completion_tokens, mood=labels["mood"], type="completion")
+        return response
+
+    async def _request(self, system_prompt: str, user_prompt: str, n: int, mood: Optional[str] = None) -> List[str]:
+        async with self._semaphore:
+            response = await self._create(system_prompt, user_prompt, mood=mood, n=n)
+        return [choice.message.content.strip() for choice in response.choices]
+
+    def _hedge_delay(self) -> float:
+        """Seconds to wait before hedging: the p95 of recent completion latencies."""
+        if len(self._latencies) < 20:
+            return OPENAI_HEDGE_DELAY
+        latencies = sorted(self._latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+    async def _hedged_request(self, system_prompt: str, user_prompt: str, n: int,
+                              mood: Optional[str] = None) -> List[str]:
+        """Make a request, firing a second identical one if the first is slower than usual.
+
+        Whichever succeeds first wins and the other is cancelled.
+        """
+        first = asyncio.create_task(self._request(system_prompt, user_prompt, n, mood))
+        done, _ = await asyncio.wait({first}, timeout=self._hedge_delay())
+        if done or self.breaker.state != CLOSED:
+            return await first
+        self.hedges += 1
+        pending = {first, asyncio.create_task(self._request(system_prompt, user_prompt, n, mood))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _complete(self, system_prompt: str, user_prompt: str, n: int = 1,
+                        mood: Optional[str] = None) -> List[str]:
+        """Run a chat completion and return the text of every choice.
+
+        At most OPENAI_MAX_CONCURRENCY completions run at once; timeouts, connection errors,
+        rate limits and 5xx responses are retried with jittered exponential backoff. While
+        the circuit breaker is open this fails immediately with CircuitOpenError.
+        """
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError("OpenAI circuit breaker is open")
+            try:
+                if OPENAI_HEDGE:
+                    return await self._hedged_request(system_prompt, user_prompt, n, mood)
+                return await self._request(system_prompt, user_prompt, n, mood)
+            except (APIConnectionError, APIStatusError) as e:
+                if not self._is_retryable(e) or attempt == OPENAI_MAX_RETRIES:
+                    raise
+                delay = random.uniform(0, 0.5 * 2 ** attempt)
+                logger.warning(f"OpenAI request failed ({e}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def _stream(self, system_prompt: str, user_prompt: str, mood: Optional[str] = None) -> AsyncIterator[str]:
+        """Run a streaming chat completion, yielding text deltas as they arrive.
+
+        Opening the stream is retried like _complete; once text has started flowing, errors
+        are raised to the caller, which has already shown part of the response.
+        """
+        async with self._semaphore:
+            for attempt in range(OPENAI_MAX_RETRIES + 1):
+                if not self.breaker.allow():
+                    raise CircuitOpenError("OpenAI circuit breaker is open")
+                try:
+                    stream = await self._create(system_prompt, user_prompt, mood=mood, stream=True)
+                    break
+                except (APIConnectionError, APIStatusError) as e:
+                    if not self._is_retryable(e) or attempt == OPENAI_MAX_RETRIES:
+                        raise
+                    delay = random.uniform(0, 0.5 * 2 ** attempt)
+                    logger.warning(f"OpenAI stream failed to open ({e}), retrying in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    def _permission_slip_prompt(self, user_feeling: Optional[str] = None) -> str:
+        """Build the system prompt for a permission slip in the given mood."""
         base_prompt = """You are an enthusiastic, chaotic good AI that creates uplifting affirmations and gentle quests to help people find moments of joy and presence in their day! 
 
 PERSONALITY & TONE:
@@ -71,31 +245,58 @@ EXAMPLES OF BAD QUESTS:
             prompt += "Craft an affirmation that acknowledges their feelings with empathy, then suggest a gentle moment of presence that might complement their current energy. Remember to keep the warm, mindful tone while being authentic!"
         else:
             prompt = f"{base_prompt}\n\nCreate an inspiring affirmation and gentle quest that would help someone find a moment of magic in their regular day!"
-            
+        return prompt
+
+    def _slip_key(self, user_feeling: Optional[str]):
+        return ("permission_slip", user_feeling.strip().lower() if user_feeling else None)
+
+    @contextmanager
+    def generating(self, user_feeling: Optional[str] = None):
+        """Mark a permission slip for this mood as being generated outside the coalescer, e.g. streamed."""
+        key = self._slip_key(user_feeling)
+        self._streaming[key] = self._streaming.get(key, 0) + 1
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4.1-nano",
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": "Generate an affirmation and quest"}
-                ],
-                temperature=0.8,
-                max_tokens=300
-            )
-            
-            return response.choices[0].message.content.strip()
+            yield
+        finally:
+            self._streaming[key] -= 1
+            if not self._streaming[key]:
+                del self._streaming[key]
+
+    def is_generating(self, user_feeling: Optional[str] = None) -> bool:
+        """Whether a permission slip for this mood is being generated or streamed right now."""
+        key = self._slip_key(user_feeling)
+        return self.coalescer.busy(key) or key in self._streaming
+
+    async def generate_permission_slip(self, user_feeling: Optional[str] = None) -> str:
+        """Generate a personalized affirmation and quest.
+
+        Concurrent calls for the same mood share one multi-choice completion, each getting
+        its own choice.
+        """
+        return await self.coalescer.submit(
+            self._slip_key(user_feeling), lambda n: self.generate_permission_slips(user_feeling, n=n))
+
+    async def stream_permission_slip(self, user_feeling: Optional[str] = None) -> AsyncIterator[str]:
+        """Generate a personalized affirmation and quest, yielding the text as it's written.
+
+        Unlike generate_permission_slips there's no fallback: errors, including failing to
+        start the stream, are raised so the caller can replace what it has shown so far.
+        """
+        prompt = self._permission_slip_prompt(user_feeling)
+        async for delta in self._stream(prompt, "Generate an affirmation and quest", mood=user_feeling):
+            yield delta
+
+    async def generate_permission_slips(self, user_feeling: Optional[str] = None, n: int = 1) -> List[str]:
+        """Generate `n` distinct affirmations and quests for the same mood in a single completion."""
+        prompt = self._permission_slip_prompt(user_feeling)
+        try:
+            return await self._complete(prompt, "Generate an affirmation and quest", n=n, mood=user_feeling)
         except Exception as e:
             logger.error(f"Error generating affirmation and quest: {e}")
-            return ("✨ MINDFUL MOMENT ✨\n\n"
-                   "🌟 YOU CARRY INFINITE WONDER WITHIN YOU! 🌟\n"
-                   "IN THIS MOMENT, YOU HAVE EVERYTHING YOU NEED TO CREATE A POCKET OF PEACE! ✨\n\n"
-                   "🍃 Today's Gentle Quest: Pause & Breathe\n"
-                   "Find a quiet spot and take three deep breaths. With each breath, notice how the air feels flowing in and out. "
-                   "Let this be your anchor to the present moment.\n\n"
-                   "Remember: These tiny moments of presence are like dropping pebbles in a pond - "
-                   "their ripples of peace can spread throughout your entire day. 💫")
-
-    def generate_daily_message(self) -> str:
+            # Template slips are instant and still differ from user to user
+            return generate_slips(user_feeling, n)
+
+    async def generate_daily_message(self) -> str:
         """Generate a daily affirmation and quest."""
         prompt = """You are an inspiring and motivational AI that creates daily affirmations and quests to help people live more meaningful and interesting lives.
 
@@ -121,20 +322,7 @@ Examples of good quests:
 Keep the tone positive and encouraging, but authentic. Use emojis sparingly but effectively."""
             
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4.1-nano",
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": "Generate today's affirmation and quest"}
-                ],
-                temperature=0.8,
-                max_tokens=300
-            )
-            
-            return response.choices[0].message.content.strip()
+            return (await self._complete(prompt, "Generate today's affirmation and quest", mood="daily"))[0]
         except Exception as e:
             logger.error(f"Error generating daily message: {e}")
-            return ("🌅 DAILY AFFIRMATION:\n"
-                   "I am capable of creating beautiful moments and meaningful connections in my life.\n\n"
-                   "🎯 TODAY'S QUEST:\n"
-                   "Share a genuine compliment with three different people today, focusing on their actions or character rather than appearances.") 
\ No newline at end of file
+            return FALLBACK_DAILY_MESSAGE 
\ No newline at end of file
@@ -0,0 +1,271 @@
+"""Benchmark the daily broadcast against fake Telegram and OpenAI servers.
+
+    BENCH_DATABASE_URL=postgresql://localhost/questbot_bench python bench/broadcast_bench.py \\
+        --subscribers 1000 10000 100000 --json results.json
+
+THE BENCHMARK DATABASE IS WIPED: every bot table in it is dropped before each run, so never
+point it at a database you care about. It is never taken from DATABASE_URL, and the run is
+refused if it matches the bot's configured database unless --allow-bot-database is given.
+It must be Postgres, since the bot's queries are.
+
+For each subscriber count the harness seeds that many subscribers due in the current
+minute, then runs the real pre-generation job and the delivery tick from quest_bot against
+local stand-ins for the Bot API and OpenAI (see fake_telegram.py and fake_openai.py, whose
+latency and error rates are configurable). Each size runs in a fresh process so peak memory
+is comparable between them. Results can be written as JSON to diff runs for regressions.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+MOODS = ["Creative", "Physical", "Social", "Reflection", "Unhinged", "Unhinged Maximum", "Surprise me"]
+TABLES = ["subscribers", "delivery_queue", "delivery_leases", "quest_completions", "daily_messages",
+          "quest_library", "quest_seen"]
+
+
+def serve_fakes(args):
+    """Run the fake Bot API and OpenAI servers until the process is terminated."""
+    sys.path.insert(0, BENCH_DIR)
+    import logging
+    import fake_openai
+    import fake_telegram
+
+    # Injected errors would otherwise log a line each
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+
+    async def main():
+        telegram = fake_telegram.FakeTelegram(latency=args.tg_latency, jitter=args.tg_jitter,
+                                              rate_limit_rate=args.tg_429, failure_rate=args.tg_fail,
+                                              blocked_rate=args.tg_blocked)
+        openai = fake_openai.FakeOpenAI(latency=args.ai_latency, jitter=args.ai_jitter,
+                                        rate_limit_rate=args.ai_429, failure_rate=args.ai_fail)
+        fake_telegram.make_app(telegram).listen(args.tg_port, address="127.0.0.1")
+        fake_openai.make_app(openai).listen(args.ai_port, address="127.0.0.1")
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+class TimedBot:
+    """Wraps a Bot to time every send_message call the broadcaster makes."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.latencies = []
+        self.errors = Counter()
+
+    async def send_message(self, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await self.bot.send_message(**kwargs)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            raise
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def fetch_stats(port: int) -> dict:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{port}/stats")).json()
+
+
+async def bench_size(subscribers: int, args) -> dict:
+    sys.path.insert(0, REPO_DIR)
+    from sqlalchemy import text
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+    import quest_bot as qb
+
+    db = qb.db
+    async with db.engine.connect() as conn:
+        await conn.execute(text(f"DROP TABLE IF EXISTS {', '.join(TABLES)} CASCADE"))
+        await conn.commit()
+    await qb.post_init(None)
+
+    slot = qb.datetime.now(qb.timezone.utc).replace(second=0, microsecond=0)
+    async with db.engine.connect() as conn:
+        await conn.execute(text("""
+            INSERT INTO subscribers (user_id, first_name, mood, timezone, delivery_minute)
+            SELECT g, 'User' || g, (CAST(:moods AS TEXT[]))[1 + g % :mood_count], 'UTC', :minute
+            FROM generate_series(1, :subscribers) AS g
+        """), {"moods": MOODS, "mood_count": len(MOODS), "minute": slot.hour * 60 + slot.minute,
+               "subscribers": subscribers})
+        await conn.commit()
+    await db.load_schedule()
+    # Cover the seeded minute even if the clock has moved on since
+    qb.last_delivery_tick = slot
+
+    bot = Bot("123:bench", base_url=f"http://127.0.0.1:{args.tg_port}/bot",
+              request=HTTPXRequest(connection_pool_size=args.concurrency + 8, pool_timeout=30))
+    await bot.initialize()
+    timed = TimedBot(bot)
+    context = SimpleNamespace(bot=timed)
+    telegram_before = await fetch_stats(args.tg_port)
+    openai_before = await fetch_stats(args.ai_port)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    pregenerate_seconds = None
+    if not args.skip_pregenerate:
+        started = time.perf_counter()
+        await qb.pregenerate_daily_messages(context)
+        pregenerate_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await qb.send_daily_messages(context)
+    send_seconds = time.perf_counter() - started
+
+    telegram_after = await fetch_stats(args.tg_port)
+    openai_after = await fetch_stats(args.ai_port)
+    await bot.shutdown()
+    await qb.post_shutdown(None)
+
+    sent = len(timed.latencies)
+    return {
+        "subscribers": subscribers,
+        "sent": sent,
+        "send_seconds": round(send_seconds, 3),
+        "messages_per_second": round(sent / send_seconds, 1) if send_seconds else 0.0,
+        "pregenerate_seconds": round(pregenerate_seconds, 3) if pregenerate_seconds is not None else None,
+        "p50_ms": round(percentile(timed.latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(timed.latencies, 0.99) * 1000, 1),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_growth_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1),
+        "send_errors": dict(timed.errors),
+        "telegram": {key: telegram_after[key] - telegram_before[key] for key in telegram_after},
+        "openai": {key: openai_after[key] - openai_before[key] for key in openai_after},
+    }
+
+
+def run_size(subscribers: int, args, results):
+    """Child process entry point: configure the bot for the fakes, then benchmark one size."""
+    os.environ.update({
+        "DATABASE_URL": args.database_url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.ai_port}/v1",
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{args.tg_port}/bot",
+        "BROADCAST_RATE": str(args.rate),
+        "BROADCAST_CONCURRENCY": str(args.concurrency),
+        "BROADCAST_PROGRESS_EVERY": "0",
+    })
+    import logging
+    import traceback
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        results.put(asyncio.run(bench_size(subscribers, args)))
+    except BaseException:
+        # The parent is waiting on the queue, so always answer it
+        results.put({"error": traceback.format_exc()})
+        raise
+
+
+def wait_for_result(worker, results) -> dict:
+    """The result run_size put on the queue, or an error if the worker died without one."""
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not worker.is_alive():
+                return {"error": f"benchmark process exited with code {worker.exitcode} without a result"}
+
+
+def bot_database_urls():
+    """The databases the bot itself would use, from the environment and the repo's .env."""
+    from dotenv import dotenv_values
+    configured = dotenv_values(os.path.join(REPO_DIR, ".env"))
+    return {url for source in (os.environ, configured)
+            for url in (source.get("DATABASE_URL"), source.get("QUEST_BOT_DATABASE_URL")) if url}
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return
+        except httpx.HTTPError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="Postgres database to wipe and use (default: $BENCH_DATABASE_URL)")
+    parser.add_argument("--allow-bot-database", action="store_true",
+                        help="run even if the benchmark database is the one the bot is configured to use")
+    parser.add_argument("--rate", type=float, default=1000, help="broadcast messages/s (Telegram allows ~30)")
+    parser.add_argument("--concurrency", type=int, default=50, help="broadcast workers")
+    parser.add_argument("--skip-pregenerate", action="store_true", help="only time the delivery tick")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--tg-port", type=int, default=8091)
+    parser.add_argument("--tg-latency", type=float, default=0.03, help="base Bot API latency in seconds")
+    parser.add_argument("--tg-jitter", type=float, default=0.01, help="mean extra exponential latency")
+    parser.add_argument("--tg-429", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--tg-fail", type=float, default=0.0, help="fraction of sends answered with 502")
+    parser.add_argument("--tg-blocked", type=float, default=0.0, help="fraction of sends answered with 403")
+    parser.add_argument("--ai-port", type=int, default=8092)
+    parser.add_argument("--ai-latency", type=float, default=0.5, help="base completion latency in seconds")
+    parser.add_argument("--ai-jitter", type=float, default=0.2)
+    parser.add_argument("--ai-429", type=float, default=0.0)
+    parser.add_argument("--ai-fail", type=float, default=0.0)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("set --database-url or BENCH_DATABASE_URL (the database will be wiped)")
+    if args.database_url in bot_database_urls() and not args.allow_bot_database:
+        parser.error("the benchmark database is the bot's own DATABASE_URL/QUEST_BOT_DATABASE_URL and would "
+                     "be wiped; point it at a dedicated database or pass --allow-bot-database")
+
+    spawn = multiprocessing.get_context("spawn")
+    fakes = spawn.Process(target=serve_fakes, args=(args,), daemon=True)
+    fakes.start()
+    try:
+        wait_for_port(args.tg_port)
+        wait_for_port(args.ai_port)
+        results = []
+        for subscribers in args.subscribers:
+            result_queue = spawn.Queue()
+            worker = spawn.Process(target=run_size, args=(subscribers, args, result_queue))
+            worker.start()
+            result = wait_for_result(worker, result_queue)
+            worker.join()
+            if "error" in result:
+                sys.exit(f"Benchmark with {subscribers} subscribers failed:\n{result['error']}")
+            results.append(result)
+            pregenerate = "skipped" if result['pregenerate_seconds'] is None else f"{result['pregenerate_seconds']}s"
+            print(f"{result['subscribers']:>7} subscribers: {result['sent']} sent in {result['send_seconds']}s "
+                  f"({result['messages_per_second']} msg/s), p50={result['p50_ms']}ms p99={result['p99_ms']}ms, "
+                  f"peak RSS {result['peak_rss_mb']}MB, pre-generation {pregenerate}, "
+                  f"errors {result['send_errors']}, OpenAI {result['openai']}", flush=True)
+    finally:
+        fakes.terminate()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args) | {"database_url": None}, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""A minimal fake of the OpenAI chat completions endpoint for local load testing.
+
+Point the bot at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1. Completions are made
+from the quest templates, with optional latency and injected 429 and 500 responses.
+Streaming requests are answered as server-sent events, a few words per chunk.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict
+
+import tornado.web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from quest_templates import generate_slip  # noqa: E402
+
+
+class FakeOpenAI:
+    """Fault settings and counters shared by the fake completion handler."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit_rate: float = 0.0,
+                 failure_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.choices = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "choices": self.choices,
+                "rate_limited": self.rate_limited, "failed": self.failed}
+
+
+class ChatCompletionsHandler(tornado.web.RequestHandler):
+    def initialize(self, openai: FakeOpenAI):
+        self.openai = openai
+
+    def _error(self, status: int, kind: str, message: str):
+        self.set_status(status)
+        self.write({"error": {"message": message, "type": kind, "param": None, "code": None}})
+
+    async def post(self):
+        openai = self.openai
+        openai.requests += 1
+        body = json.loads(self.request.body)
+        if openai.latency or openai.jitter:
+            await asyncio.sleep(openai.latency + (random.expovariate(1 / openai.jitter) if openai.jitter else 0))
+        roll = random.random()
+        if roll < openai.rate_limit_rate:
+            openai.rate_limited += 1
+            return self._error(429, "rate_limit_error", "Rate limit reached")
+        if roll < openai.rate_limit_rate + openai.failure_rate:
+            openai.failed += 1
+            return self._error(500, "server_error", "The server had an error while processing your request")
+
+        n = int(body.get("n") or 1)
+        openai.choices += n
+        texts = [generate_slip() for _ in range(n)]
+        created = int(time.time())
+        if body.get("stream"):
+            await self._stream(body["model"], created, texts[0])
+            return
+        words = sum(len(text.split()) for text in texts)
+        self.write({
+            "id": f"chatcmpl-fake{openai.requests}",
+            "object": "chat.completion",
+            "created": created,
+            "model": body["model"],
+            "choices": [{"index": i, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                        for i, text in enumerate(texts)],
+            "usage": {"prompt_tokens": 400, "completion_tokens": words, "total_tokens": 400 + words},
+        })
+
+    async def _stream(self, model: str, created: int, text: str):
+        self.set_header("Content-Type", "text/event-stream")
+        words = text.split(" ")
+        for i in range(0, len(words), 4):
+            delta = " ".join(words[i:i + 4]) + (" " if i + 4 < len(words) else "")
+            chunk = {"id": f"chatcmpl-fake{self.openai.requests}", "object": "chat.completion.chunk",
+                     "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]}
+            self.write(f"data: {json.dumps(chunk)}\n\n")
+            await self.flush()
+            await asyncio.sleep(0.01)
+        self.write("data: [DONE]\n\n")
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, openai: FakeOpenAI):
+        self.openai = openai
+
+    def get(self):
+        self.write(self.openai.stats())
+
+
+def make_app(openai: FakeOpenAI) -> tornado.web.Application:
+    return tornado.web.Application([
+        (r"/v1/chat/completions", ChatCompletionsHandler, {"openai": openai}),
+        (r"/stats", StatsHandler, {"openai": openai}),
+    ])
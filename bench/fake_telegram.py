@@ -0,0 +1,145 @@
+"""A minimal in-process fake of the Telegram Bot API for local load testing.
+
+Point the bot at it with TELEGRAM_BASE_URL=http://127.0.0.1:<port>/bot. It answers the
+methods the bot calls with plausible results, and can add latency and inject flood-control
+(429), server (502) and blocked-user (403) errors into sendMessage.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from typing import Dict, List, Optional
+
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "QuestBot", "username": "quest_bot"}
+
+
+class FakeTelegram:
+    """State shared by the fake API handlers: counters, webhook config, waiters and fault settings."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: int = 1, failure_rate: float = 0.0, blocked_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.failure_rate = failure_rate
+        self.blocked_rate = blocked_rate
+        self.sent = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.blocked = 0
+        self.webhook: Optional[Dict[str, str]] = None
+        self.webhook_set = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+
+    def wait_for_message(self, chat_id: int) -> asyncio.Future:
+        """A future resolved with the next message the bot sends to chat_id."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append(future)
+        return future
+
+    def record_message(self, params: Dict[str, str]) -> Dict:
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        self.sent += 1
+        for future in self._waiters.pop(chat_id, []):
+            if not future.done():
+                future.set_result(message)
+        return message
+
+    def fault(self) -> Optional[tuple]:
+        """An injected (status, body) error for a sendMessage call, or None to let it through."""
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        roll -= self.rate_limit_rate
+        if roll < self.failure_rate:
+            self.failed += 1
+            return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+        roll -= self.failure_rate
+        if roll < self.blocked_rate:
+            self.blocked += 1
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        return None
+
+    def call(self, method: str, params: Dict[str, str]):
+        """Result for a Bot API call, or raise KeyError for an unknown method."""
+        method = method.lower()
+        if method == "getme":
+            return BOT_USER
+        if method == "setwebhook":
+            self.webhook = params
+            self.webhook_set.set()
+            return True
+        if method in ("deletewebhook", "setmycommands", "answercallbackquery", "sendchataction"):
+            return True
+        if method == "getupdates":
+            return []
+        if method in ("sendmessage", "editmessagetext"):
+            return self.record_message(params)
+        raise KeyError(method)
+
+    def stats(self) -> Dict[str, int]:
+        return {"sent": self.sent, "rate_limited": self.rate_limited, "failed": self.failed, "blocked": self.blocked}
+
+
+class BotAPIHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram: FakeTelegram):
+        self.telegram = telegram
+
+    async def post(self, token: str, method: str):
+        params = {name: self.get_body_argument(name) for name in self.request.body_arguments}
+        if not params and self.request.body and self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = {name: str(value) for name, value in json.loads(self.request.body).items()}
+        telegram = self.telegram
+        if method.lower() in ("sendmessage", "editmessagetext"):
+            if telegram.latency or telegram.jitter:
+                await asyncio.sleep(telegram.latency + (random.expovariate(1 / telegram.jitter) if telegram.jitter else 0))
+            fault = telegram.fault()
+            if fault:
+                self.set_status(fault[0])
+                self.write(fault[1])
+                return
+        try:
+            result = telegram.call(method, params)
+        except KeyError:
+            self.set_status(404)
+            self.write({"ok": False, "error_code": 404, "description": f"Not Found: method {method} not found"})
+            return
+        if method.lower() == "getupdates":
+            # Behave like a long poll with nothing to deliver, without tying up the client for long
+            await asyncio.sleep(1)
+        self.write({"ok": True, "result": result})
+
+    get = post
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram: FakeTelegram):
+        self.telegram = telegram
+
+    def get(self):
+        self.write(self.telegram.stats())
+
+
+def make_app(telegram: FakeTelegram) -> tornado.web.Application:
+    return tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", BotAPIHandler, {"telegram": telegram}),
+        (r"/stats", StatsHandler, {"telegram": telegram}),
+    ])
@@ -0,0 +1,269 @@
+"""Drive the bot's command handlers with synthetic updates and report per-command latency.
+
+    python bench/handler_load.py --updates 5000 --concurrency 64 --db-latency 0.005 --ai-latency 2
+
+Updates go through the real Application built by quest_bot.build_application, so handler
+order, the /setmood conversation, admission control and the shared HTTP pools all behave as
+in production. The Bot API and OpenAI are the fakes from fake_telegram.py and fake_openai.py,
+run in a separate process, and the database is an in-memory stand-in that sleeps for
+--db-latency on every call that would be a round trip. Each virtual user belongs to one
+worker, so a user's conversation steps never overlap.
+
+The report gives p50/p95/p99 and throughput per command, which shows how slow /quest
+generations hold up cheap commands like /leaderboard at a given concurrency.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+from broadcast_bench import REPO_DIR, percentile, serve_fakes, wait_for_port
+from webhook_client import make_update
+
+sys.path.insert(0, REPO_DIR)
+from delivery_schedule import DeliverySchedule  # noqa: E402
+from leaderboard import Leaderboard  # noqa: E402
+from quest_db import STATE_CACHE_SIZE, STATE_CACHE_TTL  # noqa: E402
+from ttl_cache import TTLCache, MISSING  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Relative weight of each scenario in the mix; "setmood" is the two-step conversation
+DEFAULT_MIX = "quest=1,leaderboard=4,quest_completed=2,subscribe=1,setmood=1"
+
+
+class StubDB:
+    """In-memory stand-in for AsyncQuestBotDB covering what the interactive handlers call.
+
+    Reads that the real class answers from its caches or the in-memory leaderboard are free
+    here too; everything else sleeps for `latency` (plus exponential jitter) first.
+    """
+
+    # Code that skips the database when there's no engine should treat this one as connected
+    engine = "stub"
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.queries = Counter()
+        self.leaderboard = Leaderboard()
+        self.leaderboard.load([])
+        self.schedule = DeliverySchedule()
+        self._moods = {}
+        self._subscribers = set()
+        self._mood_cache = TTLCache(STATE_CACHE_SIZE, STATE_CACHE_TTL)
+        self._subscribed_cache = TTLCache(STATE_CACHE_SIZE, STATE_CACHE_TTL)
+        self._library = []
+        self._seen = {}
+
+    async def _round_trip(self, name: str):
+        self.queries[name] += 1
+        delay = self.latency + (random.expovariate(1 / self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def _cached(self, cache, user_id: int, name: str, load):
+        value = cache.get(user_id)
+        if value is MISSING:
+            await self._round_trip(name)
+            value = load()
+            cache.set(user_id, value)
+        return value
+
+    async def is_subscribed(self, user_id: int, cached: bool = True) -> bool:
+        if not cached:
+            self._subscribed_cache.invalidate(user_id)
+        return await self._cached(self._subscribed_cache, user_id, "is_subscribed",
+                                  lambda: user_id in self._subscribers)
+
+    async def add_subscriber(self, user_id: int, first_name: str = None, last_name: str = None,
+                             username: str = None):
+        await self._round_trip("add_subscriber")
+        self._subscribers.add(user_id)
+        self._subscribed_cache.invalidate(user_id)
+        self.leaderboard.add(user_id, first_name, username)
+        return True, None
+
+    async def update_user_info(self, user_id: int, first_name: str = None, last_name: str = None,
+                               username: str = None):
+        # Buffered and flushed by a job in the real class
+        self.leaderboard.set_profile(user_id, first_name, username)
+        return True
+
+    async def get_mood(self, user_id: int):
+        return await self._cached(self._mood_cache, user_id, "get_mood", lambda: self._moods.get(user_id))
+
+    async def set_mood(self, user_id: int, mood: str) -> bool:
+        await self._round_trip("set_mood")
+        self._moods[user_id] = mood
+        self._mood_cache.invalidate(user_id)
+        return True
+
+    async def complete_quest(self, user_id: int, first_name: str = None, last_name: str = None,
+                             username: str = None):
+        # Users already on the board are buffered; the first completion is written straight away
+        if self.leaderboard.get_count(user_id) is None:
+            await self._round_trip("complete_quest")
+            self.leaderboard.add(user_id, first_name, username)
+        new_total = self.leaderboard.increment(user_id)
+        return new_total, self.leaderboard.rank(user_id) == 1
+
+    async def get_leaderboard(self, limit: int = 10):
+        return self.leaderboard.top(limit)
+
+    async def get_rank(self, user_id: int):
+        return self.leaderboard.rank(user_id)
+
+    async def load_quest_library(self):
+        await self._round_trip("load_quest_library")
+        return list(self._library)
+
+    async def add_library_quests(self, mood: str, messages):
+        await self._round_trip("add_library_quests")
+        rows = []
+        for message in messages:
+            self._library.append((len(self._library) + 1, mood, message))
+            rows.append((len(self._library), message))
+        return rows
+
+    async def get_seen_quests(self, user_ids):
+        await self._round_trip("get_seen_quests")
+        return {user_id: self._seen[user_id] for user_id in user_ids if user_id in self._seen}
+
+    async def mark_quests_seen(self, seen) -> bool:
+        await self._round_trip("mark_quests_seen")
+        return True
+
+
+def parse_mix(mix: str):
+    scenarios, weights = [], []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        scenarios.append(name.strip())
+        weights.append(float(weight or 1))
+    return scenarios, weights
+
+
+def scenario_steps(scenario: str, rng: random.Random):
+    """(label, text) messages one user sends for a scenario, in order."""
+    if scenario == "setmood":
+        import quest_bot
+        return [("setmood", "/setmood"), ("setmood choice", rng.choice(quest_bot.MOODS))]
+    return [(scenario, f"/{scenario}")]
+
+
+async def drive(application, args):
+    from telegram import Update
+
+    scenarios, weights = parse_mix(args.mix)
+    latencies = defaultdict(list)
+    errors = Counter()
+    update_ids = itertools.count(1)
+    remaining = itertools.count()
+    # process_update hands handler exceptions to the error handlers rather than raising them
+    failed = set()
+
+    async def record_error(update, context):
+        failed.add(update.update_id)
+        logger.warning(f"Handler failed for update {update.update_id}: {context.error!r}")
+
+    application.add_error_handler(record_error)
+
+    async def worker(index: int):
+        rng = random.Random(index)
+        users = range(1_000_000 + index, 1_000_000 + args.users, args.concurrency)
+        while next(remaining) < args.updates:
+            user_id = rng.choice(users)
+            for label, text in scenario_steps(rng.choices(scenarios, weights)[0], rng):
+                update = Update.de_json(make_update(next(update_ids), user_id, text), application.bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                if update.update_id in failed:
+                    errors[label] += 1
+                else:
+                    latencies[label].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(args.concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def run(args):
+    import quest_bot as qb
+    from quest_library import QuestLibrary
+
+    qb.db = StubDB(args.db_latency, args.db_jitter)
+    qb.quest_library = QuestLibrary(qb.ai, qb.db)
+    application = qb.build_application()
+    # Handlers only; the jobs and post_init need a real database
+    await application.initialize()
+    try:
+        latencies, errors, elapsed = await drive(application, args)
+    finally:
+        await application.shutdown()
+        await qb.ai.close()
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total} updates in {elapsed:.2f}s ({total / elapsed:.1f} updates/s) "
+          f"at concurrency {args.concurrency}")
+    print(f"{'command':<18}{'count':>8}{'per s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for label in sorted(set(latencies) | set(errors)):
+        values = latencies[label]
+        print(f"{label:<18}{len(values):>8}{len(values) / elapsed:>9.1f}"
+              f"{percentile(values, 0.5) * 1000:>10.1f}{percentile(values, 0.95) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}{errors[label]:>8}")
+    print(f"database round trips: {dict(qb.db.queries)}")
+    print(f"admission: {qb.quest_admission.stats()}, library: {qb.quest_library.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000, help="scenarios to run in total")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates in flight at once")
+    parser.add_argument("--users", type=int, default=5000, help="distinct fake users")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"scenario weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per database round trip")
+    parser.add_argument("--db-jitter", type=float, default=0.002)
+    parser.add_argument("--tg-port", type=int, default=8091)
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="base Bot API latency in seconds")
+    parser.add_argument("--tg-jitter", type=float, default=0.02)
+    parser.add_argument("--tg-429", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--tg-fail", type=float, default=0.0, help="fraction of sends answered with 502")
+    parser.add_argument("--tg-blocked", type=float, default=0.0, help="fraction of sends answered with 403")
+    parser.add_argument("--ai-port", type=int, default=8092)
+    parser.add_argument("--ai-latency", type=float, default=1.5, help="base completion latency in seconds")
+    parser.add_argument("--ai-jitter", type=float, default=0.5)
+    parser.add_argument("--ai-429", type=float, default=0.0)
+    parser.add_argument("--ai-fail", type=float, default=0.0)
+    args = parser.parse_args()
+    # Every worker needs at least one user of its own
+    args.users = max(args.users, args.concurrency)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # Configure the bot for the fakes before quest_bot is imported
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.pop("QUEST_BOT_DATABASE_URL", None)
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123:load",
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{args.tg_port}/bot",
+        "OPENAI_API_KEY": "load",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.ai_port}/v1",
+    })
+    fakes = multiprocessing.get_context("spawn").Process(target=serve_fakes, args=(args,), daemon=True)
+    fakes.start()
+    try:
+        wait_for_port(args.tg_port)
+        wait_for_port(args.ai_port)
+        asyncio.run(run(args))
+    finally:
+        fakes.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Drive the bot's webhook with synthetic updates and measure reply latency.
+
+Start this first, then the bot pointed at it:
+
+    python bench/webhook_client.py --updates 2000 --concurrency 100
+    TELEGRAM_BOT_TOKEN=123:fake TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot \\
+        WEBHOOK_URL=http://127.0.0.1:8443/telegram python quest_bot.py
+
+The script serves a fake Bot API, waits for the bot to register its webhook (which also
+tells it the secret token), then POSTs updates from distinct users and times how long each
+takes to come back as a sendMessage.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import statistics
+import time
+
+import httpx
+
+from fake_telegram import FakeTelegram, make_app
+
+logger = logging.getLogger(__name__)
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    command_length = len(text.split()[0]) if text.startswith('/') else 0
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": text,
+    }
+    if command_length:
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+    return {"update_id": update_id, "message": message}
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def drive(telegram: FakeTelegram, updates: int, concurrency: int, text: str, timeout: float):
+    webhook = telegram.webhook
+    headers = {}
+    if webhook.get("secret_token"):
+        headers["X-Telegram-Bot-Api-Secret-Token"] = webhook["secret_token"]
+    latencies = []
+    errors = 0
+    ids = itertools.count(1)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(client: httpx.AsyncClient, update_id: int):
+        nonlocal errors
+        user_id = 1_000_000 + update_id
+        async with semaphore:
+            reply = telegram.wait_for_message(user_id)
+            started = time.perf_counter()
+            try:
+                response = await client.post(webhook["url"], json=make_update(update_id, user_id, text), headers=headers)
+                response.raise_for_status()
+                await asyncio.wait_for(reply, timeout)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                logger.warning(f"Update {update_id} failed: {e!r}")
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client, next(ids)) for _ in range(updates)))
+        elapsed = time.perf_counter() - started
+
+    print(f"{len(latencies)}/{updates} replies in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.1f} updates/s, {errors} errors)")
+    if latencies:
+        print(f"latency p50={percentile(latencies, 0.5) * 1000:.1f}ms "
+              f"p99={percentile(latencies, 0.99) * 1000:.1f}ms "
+              f"mean={statistics.mean(latencies) * 1000:.1f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081, help="port for the fake Bot API")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--text", default="/help", help="message text sent by every fake user")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    telegram = FakeTelegram()
+    make_app(telegram).listen(args.port, address="127.0.0.1")
+    print(f"Fake Bot API on http://127.0.0.1:{args.port}/bot, waiting for the bot to set its webhook...")
+    await telegram.webhook_set.wait()
+    print(f"Webhook registered at {telegram.webhook['url']}")
+    # Give the bot a moment to start its webhook server after registering
+    await asyncio.sleep(1)
+    await drive(telegram, args.updates, args.concurrency, args.text, args.timeout)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable, Optional, Tuple, Union
+
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows ~30 messages/second across all chats and ~1 message/second per chat
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '30'))
+# That limit is per bot, not per process: set this to the number of bot replicas and each one
+# sends at most BROADCAST_RATE / BROADCAST_REPLICAS, so replicas delivering at the same time
+# stay under it together
+BROADCAST_REPLICAS = max(1, int(os.getenv('BROADCAST_REPLICAS', '1')))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_CHAT_INTERVAL = float(os.getenv('BROADCAST_CHAT_INTERVAL', '1.0'))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+BROADCAST_PROGRESS_EVERY = int(os.getenv('BROADCAST_PROGRESS_EVERY', '500'))
+
+# Timeouts raised before the request left us (no free pooled connection, or no connection at
+# all), so retrying them can't deliver a message twice
+NOT_SENT_TIMEOUTS = (httpx.PoolTimeout, httpx.ConnectTimeout)
+
+Recipients = Union[Iterable[Any], AsyncIterable[Any]]
+Render = Callable[[Any], Awaitable[Tuple[int, str]]]
+OnSent = Callable[[Any, str], Awaitable[None]]
+
+
+class TokenBucket:
+    """Async token bucket handing out `rate` tokens per second, bursting up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. after Telegram flood control kicks in)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Wait until a token is available and take it. Waiters are served in FIFO order."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastStats:
+    """Progress counters for a single broadcast run."""
+
+    def __init__(self):
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        # Requests that timed out after being sent: Telegram may well have delivered them
+        self.timed_out = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked + self.timed_out
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (f"{self.done}/{self.queued} done in {self.elapsed:.1f}s "
+                f"(sent={self.sent}, failed={self.failed}, blocked={self.blocked}, "
+                f"timed_out={self.timed_out}, retried={self.retried}, rate_limited={self.rate_limited}, "
+                f"in_flight={self.in_flight}, {self.rate:.1f} msg/s)")
+
+
+class Broadcaster:
+    """Fan a message out to many chats with bounded concurrency and Telegram-friendly pacing.
+
+    A token bucket keeps this process under its share of Telegram's overall limit (see
+    BROADCAST_REPLICAS), every chat is paced to at most one message per `chat_interval`
+    seconds, and `RetryAfter` responses pause the whole bucket before the message is retried.
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE / BROADCAST_REPLICAS, concurrency: int = BROADCAST_CONCURRENCY,
+                 chat_interval: float = BROADCAST_CHAT_INTERVAL, max_retries: int = BROADCAST_MAX_RETRIES,
+                 progress_every: int = BROADCAST_PROGRESS_EVERY):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.progress_every = progress_every
+        self.last_stats = None
+        self._next_chat_slot = {}
+
+    async def _wait_for_chat(self, chat_id: int):
+        now = time.monotonic()
+        slot = max(now, self._next_chat_slot.get(chat_id, 0.0))
+        self._next_chat_slot[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _prune_chat_slots(self):
+        now = time.monotonic()
+        self._next_chat_slot = {chat_id: slot for chat_id, slot in self._next_chat_slot.items() if slot > now}
+
+    async def send(self, bot, chat_id: int, text: str, stats: BroadcastStats) -> bool:
+        """Send one message, honoring the rate limits and retrying on flood control or network errors.
+
+        Returns True once Telegram accepted the message, or when the request timed out after
+        it was sent and may have been delivered.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                stats.sent += 1
+                return True
+            except RetryAfter as e:
+                stats.rate_limited += 1
+                logger.warning(f"Flood control for chat {chat_id}, pausing broadcast for {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except Forbidden as e:
+                stats.blocked += 1
+                logger.info(f"User {chat_id} blocked the bot or is unreachable: {e}")
+                return False
+            except BadRequest as e:
+                logger.error(f"Telegram rejected message to {chat_id}: {e}")
+                break
+            except TimedOut as e:
+                if not isinstance(e.__cause__, NOT_SENT_TIMEOUTS):
+                    # The request may have reached Telegram, so a retry could deliver it twice;
+                    # it's reported as handled so the ledger doesn't resend it either
+                    stats.timed_out += 1
+                    logger.warning(f"Timed out sending to {chat_id}, not retrying: {e}")
+                    return True
+                logger.warning(f"Timed out before sending to {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except NetworkError as e:
+                logger.warning(f"Network error sending to {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+            if attempt < self.max_retries:
+                stats.retried += 1
+        stats.failed += 1
+        logger.error(f"Failed to send message to user {chat_id}")
+        return False
+
+    async def run(self, bot, recipients: Recipients, render: Render,
+                  on_sent: Optional[OnSent] = None) -> BroadcastStats:
+        """Render and send a message for every recipient.
+
+        `recipients` may be a regular or async iterable; `render(recipient)` must return a
+        `(chat_id, text)` tuple and is called from the worker pool, so generation is
+        bounded by the same concurrency limit as sending. `on_sent(recipient, text)` is
+        awaited after each message Telegram accepted or may have (see `send`).
+        """
+        stats = BroadcastStats()
+        self.last_stats = stats
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                recipient = await queue.get()
+                if recipient is None:
+                    queue.task_done()
+                    return
+                stats.in_flight += 1
+                try:
+                    chat_id, text = await render(recipient)
+                    if await self.send(bot, chat_id, text, stats) and on_sent:
+                        await on_sent(recipient, text)
+                except Exception as e:
+                    stats.failed += 1
+                    logger.error(f"Failed to deliver to {recipient}: {e}")
+                finally:
+                    stats.in_flight -= 1
+                    queue.task_done()
+                if self.progress_every and stats.done % self.progress_every == 0:
+                    logger.info(f"Broadcast progress: {stats.summary()}")
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            if hasattr(recipients, '__aiter__'):
+                async for recipient in recipients:
+                    stats.queued += 1
+                    await queue.put(recipient)
+            else:
+                for recipient in recipients:
+                    stats.queued += 1
+                    await queue.put(recipient)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            stats.finished_at = time.monotonic()
+            self._prune_chat_slots()
+        if stats.queued:
+            logger.info(f"Broadcast finished: {stats.summary()}")
+        return stats
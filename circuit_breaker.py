@@ -0,0 +1,77 @@
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a call while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stop calling a dependency that keeps failing, and probe it until it recovers.
+
+    After `failure_threshold` consecutive failures or slow calls the breaker opens and
+    allow() says no, so callers can fall back immediately. Once `reset_timeout` seconds
+    have passed it goes half-open and lets one trial call through: success closes it
+    again, failure re-opens it for another `reset_timeout`.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, slow_call_seconds: float, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._trial_started_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead now. In half-open state only one trial at a time is allowed."""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._trial_started_at = None
+            logger.info(f"{self.name} circuit half-open, sending a trial request")
+        # A trial that never reported back (e.g. it was cancelled) stops blocking after reset_timeout
+        if self.state == HALF_OPEN and (self._trial_started_at is None
+                                        or now - self._trial_started_at >= self.reset_timeout):
+            self._trial_started_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def _open(self):
+        if self.state != OPEN:
+            self.opened += 1
+            logger.warning(f"{self.name} circuit open after {self.failures} consecutive failures")
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._trial_started_at = None
+
+    def record_success(self, duration: float):
+        """Report a finished call. Calls slower than slow_call_seconds count as failures."""
+        if duration > self.slow_call_seconds:
+            logger.warning(f"{self.name} call took {duration:.1f}s")
+            self.record_failure()
+            return
+        if self.state != CLOSED:
+            logger.info(f"{self.name} circuit closed")
+        self.state = CLOSED
+        self.failures = 0
+        self._trial_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._open()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Set
+
+logger = logging.getLogger(__name__)
+
+Fetch = Callable[[int], Awaitable[List[str]]]
+
+
+class _Batch:
+    def __init__(self):
+        self.waiters: List[asyncio.Future] = []
+        self.full = asyncio.Event()
+
+
+class Coalescer:
+    """Merge identical concurrent generation requests into one multi-choice request.
+
+    Callers that submit the same key within `window` seconds of each other join one batch
+    (at most `max_batch` callers). The batch makes a single `fetch(n)` call for n choices
+    and hands each caller a different one. A batch that fills up is sent immediately and
+    later callers start a new one.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.requests = 0
+        self.fetches = 0
+        self._open: Dict[Hashable, _Batch] = {}
+        self._in_flight: Dict[Hashable, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def _fail(batch: _Batch, error: Exception):
+        for waiter in batch.waiters:
+            if not waiter.done():
+                waiter.set_exception(error)
+
+    async def _run(self, key: Hashable, batch: _Batch, fetch: Fetch):
+        try:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            if self._open.get(key) is batch:
+                del self._open[key]
+            self.fetches += 1
+            results = await fetch(len(batch.waiters))
+            if not results:
+                raise ValueError("generation returned no choices")
+        except asyncio.CancelledError:
+            # Nobody else will ever resolve these callers
+            self._fail(batch, RuntimeError(f"coalesced request for {key} was cancelled"))
+            raise
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        finally:
+            if self._open.get(key) is batch:
+                del self._open[key]
+            self._in_flight[key] -= 1
+            if not self._in_flight[key]:
+                del self._in_flight[key]
+        waiters = batch.waiters
+        if len(results) < len(waiters):
+            logger.warning(f"Coalesced request for {key} got {len(results)} choices for {len(waiters)} callers")
+        for i, waiter in enumerate(waiters):
+            if not waiter.done():
+                # Fewer choices than callers (e.g. a fallback) means some callers share one
+                waiter.set_result(results[i % len(results)])
+
+    async def submit(self, key: Hashable, fetch: Fetch) -> str:
+        """Get one choice for key, sharing the request with other callers of the same key."""
+        self.requests += 1
+        batch = self._open.get(key)
+        if batch is None:
+            batch = _Batch()
+            self._open[key] = batch
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            task = asyncio.create_task(self._run(key, batch, fetch))
+            # The event loop only keeps weak references to tasks
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        waiter = asyncio.get_running_loop().create_future()
+        batch.waiters.append(waiter)
+        if len(batch.waiters) >= self.max_batch:
+            del self._open[key]
+            batch.full.set()
+        return await waiter
+
+    def busy(self, key: Hashable) -> bool:
+        """Whether a request for key is being collected or is in flight."""
+        return key in self._in_flight
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from datetime import date
+from typing import Dict
+
+from ai_interactions import FALLBACK_DAILY_MESSAGE
+
+logger = logging.getLogger(__name__)
+
+
+class DailyMessageCache:
+    """The /today message, generated once per calendar day and shared through the database.
+
+    Lookups hit memory first, then the daily_messages table, and only then the model.
+    Concurrent requests for a date that isn't cached yet share one lookup, so a burst of
+    /today calls at midnight costs a single completion.
+    """
+
+    def __init__(self, ai, db):
+        self.ai = ai
+        self.db = db
+        self._messages: Dict[date, str] = {}
+        self._inflight: Dict[date, asyncio.Task] = {}
+
+    def _connected(self) -> bool:
+        return self.db is not None and bool(getattr(self.db, 'engine', None))
+
+    async def _load(self, message_date: date) -> str:
+        # Without a database the message is still generated once and kept in memory
+        message = await self.db.get_daily_message(message_date) if self._connected() else None
+        if message is None:
+            message = await self.ai.generate_daily_message()
+            if message == FALLBACK_DAILY_MESSAGE:
+                # Don't pin the fallback for the whole day; the next request tries again
+                return message
+            if self._connected():
+                message = await self.db.save_daily_message(message_date, message)
+            logger.info(f"Generated the daily message for {message_date}")
+        # Only today's and yesterday's messages (for users behind UTC) are still asked for
+        for old_date in [d for d in self._messages if (message_date - d).days > 1]:
+            del self._messages[old_date]
+        self._messages[message_date] = message
+        return message
+
+    async def get(self, message_date: date) -> str:
+        """Return the daily message for message_date, generating it if nobody has yet."""
+        message = self._messages.get(message_date)
+        if message is not None:
+            return message
+        task = self._inflight.get(message_date)
+        if task is None:
+            task = asyncio.create_task(self._load(message_date))
+            self._inflight[message_date] = task
+            task.add_done_callback(lambda _: self._inflight.pop(message_date, None))
+        # Shield the shared lookup so one caller's cancellation doesn't fail the others
+        return await asyncio.shield(task)
@@ -2,6 +2,7 @@ from sqlalchemy import create_engine, text
 from typing import List, Dict
 import os
 import logging
+from metrics import track_engine
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,7 @@ class EdgeOSDB:
             return
         try:
             self.engine = create_engine(db_url)
+            track_engine(self.engine, "edgeos")
             logger.info("Successfully connected to EdgeOS database")
         except Exception as e:
             logger.error(f"Failed to connect to EdgeOS database: {e}")
@@ -0,0 +1,98 @@
+import logging
+import os
+import socket
+import uuid
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+logger = logging.getLogger(__name__)
+
+# Subscribers who never picked a time get their quest at 9:00 in this timezone
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'UTC')
+DEFAULT_DELIVERY_MINUTE = 9 * 60
+
+# Every minute's deliveries are split into this many chunks, which bot processes claim with leases
+DELIVERY_SHARDS = int(os.getenv('DELIVERY_SHARDS', '8'))
+DELIVERY_LEASE_SECONDS = int(os.getenv('DELIVERY_LEASE_SECONDS', '120'))
+# Identifies this process as the owner of the chunks it claims
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def get_zone(name: Optional[str]) -> Optional[ZoneInfo]:
+    """Return the ZoneInfo for an IANA timezone name, or None if it isn't one."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        return None
+
+
+class DeliverySchedule:
+    """Minute-bucketed index of when each subscriber's daily quest is due.
+
+    Subscribers are bucketed by the UTC minute of the day their local delivery time falls on,
+    so each scheduler tick only looks at the handful of users due in that minute. UTC offsets
+    move with daylight saving time, so the index should be rebuilt once a day.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._buckets = defaultdict(set)
+        self._entries = {}
+
+    def _utc_minute(self, zone: ZoneInfo, local_minute: int, on: date) -> int:
+        local = datetime.combine(on, time(local_minute // 60, local_minute % 60), tzinfo=zone)
+        utc = local.astimezone(timezone.utc)
+        return utc.hour * 60 + utc.minute
+
+    def add(self, user_id: int, timezone_name: Optional[str] = None, local_minute: Optional[int] = None,
+            on: Optional[date] = None):
+        """Schedule (or reschedule) a user's daily delivery at local_minute in their timezone."""
+        self.remove(user_id)
+        zone = get_zone(timezone_name or DEFAULT_TIMEZONE) or ZoneInfo('UTC')
+        if local_minute is None:
+            local_minute = DEFAULT_DELIVERY_MINUTE
+        utc_minute = self._utc_minute(zone, local_minute, on or datetime.now(zone).date())
+        self._buckets[utc_minute].add(user_id)
+        self._entries[user_id] = (utc_minute, zone, local_minute)
+
+    def remove(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry:
+            bucket = self._buckets[entry[0]]
+            bucket.discard(user_id)
+            if not bucket:
+                del self._buckets[entry[0]]
+
+    def load(self, rows: Iterable[Tuple[int, Optional[str], Optional[int]]]):
+        """Rebuild the index from (user_id, timezone, delivery_minute) rows."""
+        self._buckets = defaultdict(set)
+        self._entries = {}
+        for user_id, timezone_name, local_minute in rows:
+            self.add(user_id, timezone_name, local_minute)
+        self.loaded = True
+        logger.info(f"Delivery schedule loaded: {len(self._entries)} users in {len(self._buckets)} minute buckets")
+
+    def due_between(self, start: datetime, end: datetime) -> List[Tuple[int, date]]:
+        """(user_id, local delivery date) for every delivery due in [start, end).
+
+        start and end are timezone-aware; only whole minutes are considered.
+        """
+        due = []
+        current = start.astimezone(timezone.utc).replace(second=0, microsecond=0)
+        end = end.astimezone(timezone.utc)
+        while current < end:
+            for user_id in self._buckets.get(current.hour * 60 + current.minute, ()):
+                zone = self._entries[user_id][1]
+                due.append((user_id, current.astimezone(zone).date()))
+            current += timedelta(minutes=1)
+        return due
+
+    def get(self, user_id: int) -> Optional[Tuple[ZoneInfo, int]]:
+        """The user's (timezone, local delivery minute), or None if they aren't scheduled."""
+        entry = self._entries.get(user_id)
+        return (entry[1], entry[2]) if entry else None
+
+    def __len__(self):
+        return len(self._entries)
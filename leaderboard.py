@@ -0,0 +1,110 @@
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """In-memory quest leaderboard, kept in the same order as the SQL one.
+
+    Users are ranked by quests completed (descending), ties broken by user_id. Updates and
+    rank lookups are O(log n). `version` changes whenever the top `top_size` rows change,
+    including the names shown for them, so rendered leaderboards can be cached on it.
+    """
+
+    def __init__(self, top_size: int = 10):
+        self.top_size = top_size
+        self.version = 0
+        self.loaded = False
+        self._ranking = SortedList()
+        self._counts = {}
+        self._names = {}
+
+    def load(self, rows: Iterable[Tuple[int, Optional[str], Optional[str], Optional[int]]]):
+        """Replace the leaderboard with (user_id, first_name, username, quests_completed) rows."""
+        self._counts = {}
+        self._names = {}
+        for user_id, first_name, username, quests_completed in rows:
+            self._counts[user_id] = quests_completed or 0
+            self._names[user_id] = (first_name, username)
+        self._ranking = SortedList((-count, user_id) for user_id, count in self._counts.items())
+        self.loaded = True
+        self.version += 1
+        logger.info(f"Leaderboard loaded with {len(self._counts)} users")
+
+    def _in_top(self, key) -> bool:
+        return self._ranking.bisect_left(key) < self.top_size
+
+    def set(self, user_id: int, count: int) -> int:
+        """Set a user's quest count, adding them if needed. Returns the new count."""
+        old_count = self._counts.get(user_id)
+        if old_count == count:
+            return count
+        touches_top = False
+        if old_count is not None:
+            old_key = (-old_count, user_id)
+            touches_top = self._in_top(old_key)
+            self._ranking.remove(old_key)
+        new_key = (-count, user_id)
+        self._ranking.add(new_key)
+        self._counts[user_id] = count
+        self._names.setdefault(user_id, (None, None))
+        if touches_top or self._in_top(new_key):
+            self.version += 1
+        return count
+
+    def increment(self, user_id: int, by: int = 1) -> int:
+        """Add `by` completed quests to a user. Returns the new count."""
+        return self.set(user_id, self._counts.get(user_id, 0) + by)
+
+    def add(self, user_id: int, first_name: str = None, username: str = None):
+        """Add a user with no completed quests, unless they're already on the board."""
+        if user_id not in self._counts:
+            self.set(user_id, 0)
+        self.set_profile(user_id, first_name, username)
+
+    def set_profile(self, user_id: int, first_name: str = None, username: str = None):
+        """Update the names shown for a user. None keeps the current value."""
+        if user_id not in self._counts:
+            return
+        old_first_name, old_username = self._names.get(user_id, (None, None))
+        names = (first_name if first_name is not None else old_first_name,
+                 username if username is not None else old_username)
+        if names != (old_first_name, old_username):
+            self._names[user_id] = names
+            if self._in_top((-self._counts[user_id], user_id)):
+                self.version += 1
+
+    def remove(self, user_id: int):
+        """Drop a user from the leaderboard."""
+        count = self._counts.pop(user_id, None)
+        self._names.pop(user_id, None)
+        if count is None:
+            return
+        key = (-count, user_id)
+        if self._in_top(key):
+            self.version += 1
+        self._ranking.remove(key)
+
+    def get_count(self, user_id: int) -> Optional[int]:
+        return self._counts.get(user_id)
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """1-based rank of a user, or None if they're not on the board."""
+        count = self._counts.get(user_id)
+        if count is None:
+            return None
+        return self._ranking.index((-count, user_id)) + 1
+
+    def top(self, limit: int = 10) -> List[Tuple[int, Optional[str], Optional[str], int]]:
+        """Top users as (user_id, first_name, username, quests_completed) rows."""
+        rows = []
+        for negative_count, user_id in self._ranking.islice(0, limit):
+            first_name, username = self._names.get(user_id, (None, None))
+            rows.append((user_id, first_name, username, -negative_count))
+        return rows
+
+    def __len__(self):
+        return len(self._counts)
@@ -0,0 +1,274 @@
+import abc
+import bisect
+import functools
+import logging
+import os
+import re
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Prometheus endpoint (http://METRICS_LISTEN:METRICS_PORT/metrics), off unless a port is set
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+
+# Histogram upper bounds in seconds, from a cached DB read up to a slow OpenAI completion
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(abc.ABC):
+    """A named metric with a fixed set of label names, rendered in the Prometheus text format."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) for every series."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [("", _format_labels(self.labelnames, key), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """A value that goes up and down. Set it directly, or give it a function read at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], Dict[LabelValues, float]]):
+        """Read the gauge from function(), which returns {label values: value}, on every scrape."""
+        self._function = function
+
+    def samples(self):
+        values = dict(self._values)
+        if self._function:
+            try:
+                values.update(self._function())
+            except Exception as e:
+                logger.error(f"Failed to collect {self.name}: {e}")
+        return [("", _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per series: observations per bucket (the last one is +Inf), then the sum
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self):
+        samples = []
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"'),
+                                cumulative))
+            samples.append(("_sum", _format_labels(self.labelnames, key), total[0]))
+            samples.append(("_count", _format_labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+COMMAND_DURATION = REGISTRY.register(Histogram(
+    "questbot_command_duration_seconds", "Time spent handling a bot command.", ["command"]))
+COMMAND_ERRORS = REGISTRY.register(Counter(
+    "questbot_command_errors_total", "Bot commands whose handler raised.", ["command"]))
+DB_QUERY_DURATION = REGISTRY.register(Histogram(
+    "questbot_db_query_duration_seconds", "Database statement execution time.", ["database", "operation", "table"]))
+DB_QUERY_ERRORS = REGISTRY.register(Counter(
+    "questbot_db_query_errors_total", "Database statements that failed.", ["database", "operation", "table"]))
+DB_POOL_CONNECTIONS = REGISTRY.register(Gauge(
+    "questbot_db_pool_connections", "Database connection pool usage.", ["database", "role", "state"]))
+OPENAI_DURATION = REGISTRY.register(Histogram(
+    "questbot_openai_request_duration_seconds",
+    "OpenAI request time; for streams, the time until the response starts.", ["mood", "stream", "outcome"]))
+OPENAI_TOKENS = REGISTRY.register(Counter(
+    "questbot_openai_tokens_total", "OpenAI tokens used by non-streaming completions.", ["mood", "type"]))
+BROADCAST_MESSAGES = REGISTRY.register(Gauge(
+    "questbot_broadcast_messages", "Progress of the current or last broadcast run.", ["state"]))
+BROADCAST_RATE = REGISTRY.register(Gauge(
+    "questbot_broadcast_rate", "Messages per second sent by the current or last broadcast run."))
+
+
+def timed_handler(command: str, callback):
+    """Wrap a handler callback to record its duration and errors under `command`."""
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            COMMAND_ERRORS.inc(command=command)
+            raise
+        finally:
+            COMMAND_DURATION.observe(time.perf_counter() - started, command=command)
+
+    return timed
+
+
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?"?(\w+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=512)
+def _statement_labels(statement: str) -> Tuple[str, str]:
+    """(operation, table) for a SQL statement, e.g. ("SELECT", "subscribers")."""
+    words = statement.split(None, 1)
+    table = _TABLE.search(statement)
+    return (words[0].upper() if words else "", table.group(1).lower() if table else "")
+
+
+# (database, "sync" or "async") -> connection pool
+_engines = {}
+
+
+def _pool_connections() -> Dict[LabelValues, float]:
+    values = {}
+    for (database, role), pool in _engines.items():
+        # NullPool and friends don't keep counts; QueuePool's overflow is negative until the pool fills
+        for state in ("size", "checkedin", "checkedout", "overflow"):
+            if callable(getattr(pool, state, None)):
+                values[(database, role, state)] = max(0, getattr(pool, state)())
+    return values
+
+
+DB_POOL_CONNECTIONS.set_function(_pool_connections)
+
+
+def track_engine(engine, database: str):
+    """Time every statement run on a sync or async SQLAlchemy engine and report its pool."""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+    role = "async" if sync_engine is not engine else "sync"
+    _engines[(database, role)] = sync_engine.pool
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        operation, table = _statement_labels(statement)
+        DB_QUERY_DURATION.observe(time.perf_counter() - conn.info['query_started'].pop(),
+                                  database=database, operation=operation, table=table)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get('query_started'):
+            context.connection.info['query_started'].pop()
+        operation, table = _statement_labels(context.statement or "")
+        DB_QUERY_ERRORS.inc(database=database, operation=operation, table=table)
+
+
+def track_broadcaster(broadcaster):
+    """Report the progress of broadcaster's current (or last) run."""
+
+    def progress() -> Dict[LabelValues, float]:
+        stats = broadcaster.last_stats
+        if stats is None:
+            return {}
+        return {(state,): getattr(stats, state)
+                for state in ("queued", "sent", "failed", "blocked", "timed_out", "retried", "rate_limited",
+                              "in_flight")}
+
+    BROADCAST_MESSAGES.set_function(progress)
+    BROADCAST_RATE.set_function(lambda: {(): broadcaster.last_stats.rate} if broadcaster.last_stats else {})
+
+
+def start_server(port: int = METRICS_PORT, address: str = METRICS_LISTEN):
+    """Serve /metrics from the running event loop. Returns the server, or None if it couldn't start."""
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(REGISTRY.render())
+
+    try:
+        server = tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(port, address=address)
+    except OSError as e:
+        logger.error(f"Could not serve metrics on {address}:{port}: {e}")
+        return None
+    logger.info(f"Serving metrics on http://{address}:{port}/metrics")
+    return server
@@ -1,11 +1,27 @@
+import asyncio
 import os
 import logging
-from datetime import datetime, time
+import hashlib
+import hmac
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters
 from ai_interactions import AIInteractions
-from quest_db import QuestBotDB
+from quest_db import (AsyncQuestBotDB, ROSTER_BATCH_SIZE, PROFILE_FLUSH_INTERVAL,
+                      COMPLETION_FLUSH_INTERVAL, COMPLETION_ROLLUP_INTERVAL)
+from broadcast import Broadcaster, BROADCAST_CONCURRENCY
+from quest_pool import QuestPool
+from quest_library import QuestLibrary, QUEST_SEEN_FLUSH_INTERVAL
+from quest_templates import generate_slip
+from admission import AdmissionControl, ADMITTED
+from daily_message import DailyMessageCache
+from update_processor import PerUserUpdateProcessor
+from metrics import METRICS_PORT, start_server, timed_handler, track_broadcaster
+from delivery_schedule import (DEFAULT_TIMEZONE, DELIVERY_SHARDS, DELIVERY_LEASE_SECONDS, REPLICA_ID,
+                               get_zone)
 
 # Load environment variables
 load_dotenv()
@@ -20,13 +36,46 @@ logger = logging.getLogger(__name__)
 # Initialize AI and DB
 try:
     ai = AIInteractions()
-    db = QuestBotDB()
-    db.create_subscribers_table()  # Ensure the subscribers table exists
+    db = AsyncQuestBotDB()
 except Exception as e:
     logger.error(f"Failed to initialize services: {e}")
     ai = None
     db = None
 
+broadcaster = Broadcaster()
+track_broadcaster(broadcaster)
+daily_messages = DailyMessageCache(ai, db)
+quest_library = QuestLibrary(ai, db)
+quest_admission = AdmissionControl()
+
+# Pre-generate quests for deliveries due within this many minutes
+PREGENERATE_LOOKAHEAD = int(os.getenv('PREGENERATE_LOOKAHEAD_MINUTES', '120'))
+# How far back the delivery scheduler catches up after a late or missed tick
+MAX_DELIVERY_CATCHUP = int(os.getenv('MAX_DELIVERY_CATCHUP_MINUTES', '60'))
+# End of the last delivery window send_daily_messages has handled
+last_delivery_tick = None
+# Shown while a /quest is being generated, and the minimum seconds between its edits
+QUEST_STREAM_PLACEHOLDER = "✨ Conjuring your quest..."
+QUEST_STREAM_EDIT_INTERVAL = float(os.getenv('QUEST_STREAM_EDIT_INTERVAL', '1.0'))
+# Set WEBHOOK_URL to receive updates through a webhook instead of long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT') or os.getenv('PORT') or '8443')
+# Every replica behind the webhook must check the same secret, so without an explicit one
+# it is derived from the bot token rather than generated per process
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or hmac.new(
+    os.getenv('TELEGRAM_BOT_TOKEN', '').encode(), b'webhook-secret-token', hashlib.sha256).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '100'))
+# Bot API endpoint, e.g. http://127.0.0.1:8081/bot for a local Bot API server
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL')
+# Sent deliveries are recorded in the ledger in batches of this size, so a restart
+# re-sends at most this many messages
+DELIVERY_CHECKPOINT_SIZE = int(os.getenv('DELIVERY_CHECKPOINT_SIZE', '50'))
+# Reload the delivery schedule this often so other replicas' subscribers and time changes show up
+SCHEDULE_REFRESH_INTERVAL = int(os.getenv('SCHEDULE_REFRESH_INTERVAL', '3600'))
+# Prometheus endpoint, started in post_init
+metrics_server = None
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     keyboard = [
@@ -63,19 +112,21 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     last_name = user.last_name if hasattr(user, 'last_name') else None
     username = user.username if hasattr(user, 'username') else None
 
-    if not db.is_subscribed(user_id):
-        success, error = db.add_subscriber(user_id, first_name, last_name, username)
+    # Not from the cache: another replica may have handled an /unsubscribe since
+    if not await db.is_subscribed(user_id, cached=False):
+        success, error = await db.add_subscriber(user_id, first_name, last_name, username)
         if success:
             await update.message.reply_text(
-                "🌟 You're subscribed! You'll receive your first affirmation and quest "
-                "tomorrow at 9 AM.\n\nCan't wait? Use /quest to get a fun permission slip right now!"
+                "🌟 You're subscribed! You'll receive your affirmation and quest every day "
+                f"at 9 AM ({DEFAULT_TIMEZONE}). Use /timezone and /settime to pick your own time.\n\n"
+                "Can't wait? Use /quest to get a fun permission slip right now!"
             )
         else:
             await update.message.reply_text(
                 f"Sorry, there was an error subscribing you. Please try again later!\n\nError: {error}"
             )
     else:
-        db.update_user_info(user_id, first_name, last_name, username)
+        await db.update_user_info(user_id, first_name, last_name, username)
         await update.message.reply_text(
             "✨ You're already subscribed! Use /quest to get a fun permission slip now!"
         )
@@ -87,8 +138,8 @@ async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user_id = update.effective_user.id
-    if db.is_subscribed(user_id):
-        if db.remove_subscriber(user_id):
+    if await db.is_subscribed(user_id, cached=False):
+        if await db.remove_subscriber(user_id):
             await update.message.reply_text(
                 "👋 You've been unsubscribed. You'll no longer receive daily messages.\n"
                 "You can resubscribe anytime with /subscribe!"
@@ -113,18 +164,79 @@ async def quest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = user.first_name
     last_name = user.last_name if hasattr(user, 'last_name') else None
     username = user.username if hasattr(user, 'username') else None
-    db.update_user_info(user_id, first_name, last_name, username)
+    await db.update_user_info(user_id, first_name, last_name, username)
 
     try:
-        mood = db.get_mood(user_id) or "Surprise me"
-        permission_slip = ai.generate_permission_slip(mood)
-        await update.message.reply_text(permission_slip)
+        mood = await db.get_mood(user_id) or "Surprise me"
+        if quest_admission.admit(user_id) != ADMITTED:
+            # Over this user's rate or the global cap: answer right away without the model
+            await update.message.reply_text(quest_library.cached_slip(mood) or generate_slip(mood))
+            return
+        try:
+            # Served from the library when the user has unseen quests for their mood
+            permission_slip = await quest_library.take_unseen(user_id, mood)
+            if permission_slip is not None:
+                await update.message.reply_text(permission_slip)
+                return
+            if ai.is_generating(mood):
+                # Others are already asking for this mood: share one multi-choice completion with them
+                permission_slip = await ai.generate_permission_slip(mood)
+                await update.message.reply_text(permission_slip)
+            else:
+                # Otherwise write a fresh one, showing it as it's generated
+                with ai.generating(mood):
+                    message = await update.message.reply_text(QUEST_STREAM_PLACEHOLDER)
+                    try:
+                        permission_slip = await stream_to_message(message, ai.stream_permission_slip(mood))
+                    except Exception as e:
+                        logger.error(f"Error streaming quest, using a template instead: {e}")
+                        permission_slip = generate_slip(mood)
+                        await message.edit_text(permission_slip)
+            await quest_library.add_served(user_id, mood, permission_slip)
+        finally:
+            quest_admission.release()
     except Exception as e:
         logger.error(f"Error generating quest: {e}")
         await update.message.reply_text(
             "Sorry, I couldn't generate your quest right now. Please try again later!"
         )
 
+async def stream_to_message(message, chunks) -> str:
+    """Edit message to show streamed text as it arrives. Returns the complete text.
+
+    Edits are spaced at least QUEST_STREAM_EDIT_INTERVAL apart, and a flood-control
+    response pushes the next one back, so a long stream stays inside Telegram's edit limits.
+    """
+    text = ""
+    shown = None
+    next_edit = 0.0
+    loop = asyncio.get_running_loop()
+    async for chunk in chunks:
+        text += chunk
+        if loop.time() >= next_edit and text.strip() and text != shown:
+            next_edit = loop.time() + QUEST_STREAM_EDIT_INTERVAL
+            try:
+                await message.edit_text(text.rstrip() + " ▌")
+                shown = text
+            except RetryAfter as e:
+                next_edit = loop.time() + e.retry_after
+            except BadRequest as e:
+                logger.warning(f"Couldn't update streamed message: {e}")
+    text = text.strip()
+    if not text:
+        raise ValueError("the stream produced no text")
+    # Always finish on the complete text, whatever happened to the intermediate edits
+    for attempt in range(3):
+        try:
+            await message.edit_text(text)
+            break
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            logger.warning(f"Couldn't finish streamed message: {e}")
+            break
+    return text
+
 async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get today's affirmation and quest immediately."""
     if not ai:
@@ -132,7 +244,10 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        daily_message = ai.generate_daily_message()
+        # Same message for everyone on a given day, in the user's own timezone
+        schedule_entry = db.schedule.get(update.effective_user.id) if db else None
+        zone = schedule_entry[0] if schedule_entry else get_zone(DEFAULT_TIMEZONE) or timezone.utc
+        daily_message = await daily_messages.get(datetime.now(zone).date())
         await update.message.reply_text(daily_message)
     except Exception as e:
         logger.error(f"Error sending daily message: {e}")
@@ -140,40 +255,244 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Sorry, I couldn't generate today's message. Please try again later!"
         )
 
-async def send_daily_messages(context: ContextTypes.DEFAULT_TYPE):
-    """Send daily affirmations and quests to all subscribers."""
+def group_by_date(due):
+    """Group (user_id, delivery_date) pairs into {delivery_date: [user_id, ...]}."""
+    groups = {}
+    for user_id, delivery_date in due:
+        groups.setdefault(delivery_date, []).append(user_id)
+    return groups
+
+async def pregenerate_daily_messages(context: ContextTypes.DEFAULT_TYPE):
+    """Generate quests for upcoming deliveries ahead of time and store them in the delivery queue."""
     if not ai or not db:
         logger.error("Required services are not available")
         return
 
     try:
-        subscribers = db.get_all_subscribers()
-        if not subscribers:
-            logger.info("No subscribers to send messages to")
-            return
+        now = datetime.now(timezone.utc)
+        due = db.schedule.due_between(now, now + timedelta(minutes=PREGENERATE_LOOKAHEAD))
+        # Each subscriber gets a library quest they haven't seen; the library only calls the
+        # model, one multi-choice completion at a time, when a mood runs low
+        generated = 0
+
+        async def enqueue(delivery_date, pending):
+            await quest_library.prefetch_seen([user_id for user_id, _ in pending])
+            batch = {user_id: await quest_library.next_slip(user_id, mood) for user_id, mood in pending}
+            await db.enqueue_daily_messages(delivery_date, batch)
+            return len(batch)
+
+        for delivery_date, user_ids in group_by_date(due).items():
+            pending = []
+            async for user_id, mood, queued_message in db.iter_roster(delivery_date, user_ids):
+                if queued_message is not None:
+                    continue
+                pending.append((user_id, mood or "Surprise me"))
+                if len(pending) >= ROSTER_BATCH_SIZE:
+                    generated += await enqueue(delivery_date, pending)
+                    pending = []
+            if pending:
+                generated += await enqueue(delivery_date, pending)
+        await quest_library.flush_seen()
+        await db.purge_queued_messages(now.date() - timedelta(days=7))
+        await db.purge_delivery_leases(now - timedelta(days=1))
+        logger.info(f"Pre-generated {generated} daily messages for the next {PREGENERATE_LOOKAHEAD} minutes")
+    except Exception as e:
+        logger.error(f"Error pre-generating daily messages: {e}")
+
+async def deliver_chunk(bot, slot, shard, pool):
+    """Send the deliveries in one claimed (minute, shard) chunk, renewing its lease while we work."""
+    missing = 0
+    delivered = []
+
+    async def render(entry):
+        delivery_date, user_id, mood, queued_message = entry
+        if queued_message is None:
+            nonlocal missing
+            missing += 1
+            return user_id, await pool.next_slip(mood or "Surprise me")
+        return user_id, queued_message
+
+    async def checkpoint():
+        batch = delivered[:]
+        del delivered[:]
+        if not await db.mark_delivered(batch):
+            delivered.extend(batch)
+
+    async def on_sent(entry, text):
+        delivery_date, user_id = entry[0], entry[1]
+        delivered.append((delivery_date, user_id, text))
+        if len(delivered) >= DELIVERY_CHECKPOINT_SIZE:
+            await checkpoint()
+
+    lost = False
+
+    async def heartbeat(sender):
+        nonlocal lost
+        delay = DELIVERY_LEASE_SECONDS / 3
+        while True:
+            await asyncio.sleep(delay)
+            renewed = await db.renew_delivery_lease(slot, shard, REPLICA_ID, DELIVERY_LEASE_SECONDS)
+            if renewed is None:
+                # The lease is still ours until it expires, so keep sending and retry sooner
+                delay = DELIVERY_LEASE_SECONDS / 12
+                continue
+            if not renewed:
+                # Someone else has claimed the chunk and will send the rest of it
+                logger.warning(f"Lost the lease on delivery chunk {slot:%H:%M}/{shard}, stopping")
+                lost = True
+                sender.cancel()
+                return
+            delay = DELIVERY_LEASE_SECONDS / 3
+
+    # The roster is read from the database rather than the schedule, which may be up to
+    # SCHEDULE_REFRESH_INTERVAL old, through the index on the stored UTC delivery minute
+    sender = asyncio.create_task(
+        broadcaster.run(bot, db.iter_chunk_roster(slot, shard, DELIVERY_SHARDS), render, on_sent))
+    renewer = asyncio.create_task(heartbeat(sender))
+    try:
+        await sender
+    except asyncio.CancelledError:
+        if not lost:
+            raise
+    finally:
+        sender.cancel()
+        renewer.cancel()
+        await checkpoint()
+    if lost:
+        return
+    await db.complete_delivery_chunk(slot, shard, REPLICA_ID)
+    if missing:
+        logger.warning(f"{missing} daily messages were not pre-generated and were generated on the fly")
 
-        for user_id in subscribers:
-            try:
-                mood = db.get_mood(user_id) or "Surprise me"
-                daily_message = ai.generate_permission_slip(mood)
-                await context.bot.send_message(chat_id=user_id, text=daily_message)
-                logger.info(f"Sent daily message to user {user_id}")
-            except Exception as e:
-                logger.error(f"Failed to send message to user {user_id}: {e}")
+async def send_daily_messages(context: ContextTypes.DEFAULT_TYPE):
+    """Send daily affirmations and quests to the subscribers whose delivery time has come.
+
+    Runs every minute. Each minute is split into DELIVERY_SHARDS chunks in the
+    delivery_leases table, and every running bot process claims chunks until none are
+    left, so several replicas can share the load without sending anything twice. Chunks
+    whose owner died are reclaimed once their lease expires, and pick up from the delivery
+    ledger instead of starting over.
+    """
+    global last_delivery_tick
+    if not ai or not db:
+        logger.error("Required services are not available")
+        return
+
+    try:
+        window_end = datetime.now(timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # After a restart nothing says which minutes were handled, so catch up as far as allowed;
+        # the delivery ledger skips anyone who was already sent their quest
+        window_start = window_end - timedelta(minutes=MAX_DELIVERY_CATCHUP)
+        if last_delivery_tick is not None:
+            window_start = max(last_delivery_tick, window_start)
+        last_delivery_tick = window_end
+        # Every minute gets its chunks, since the in-memory schedule may not know about
+        # subscribers added or rescheduled by other replicas yet
+        minutes = int((window_end - window_start) / timedelta(minutes=1))
+        await db.create_delivery_chunks([window_start + timedelta(minutes=i) for i in range(minutes)],
+                                        DELIVERY_SHARDS)
+
+        # Pre-generation normally filled the queue already; anything missing is generated
+        # on the fly from a per-mood pool
+        pool = QuestPool(ai)
+        since = window_end - timedelta(minutes=MAX_DELIVERY_CATCHUP)
+        while True:
+            chunk = await db.claim_delivery_chunk(REPLICA_ID, since, DELIVERY_LEASE_SECONDS)
+            if chunk is None:
+                break
+            await deliver_chunk(context.bot, *chunk, pool)
     except Exception as e:
         logger.error(f"Error generating daily message: {e}")
 
+async def refresh_delivery_schedule(context: ContextTypes.DEFAULT_TYPE):
+    """Reload the delivery schedule so daylight saving changes and other processes' edits are picked up."""
+    if db:
+        await db.refresh_delivery_slots()
+        await db.load_schedule()
+
+async def flush_profile_updates(context: ContextTypes.DEFAULT_TYPE):
+    """Write buffered first_name/last_name/username changes to the database."""
+    if db:
+        await db.flush_user_info()
+
+async def flush_completions(context: ContextTypes.DEFAULT_TYPE):
+    """Write buffered quest completions to the event log."""
+    if db:
+        await db.flush_completions()
+
+async def flush_seen_quests(context: ContextTypes.DEFAULT_TYPE):
+    """Write the library quests served since the last flush to the users' seen bitmaps."""
+    if db:
+        await quest_library.flush_seen()
+
+async def rollup_completions(context: ContextTypes.DEFAULT_TYPE):
+    """Fold logged quest completions into the subscribers' counters.
+
+    The in-memory leaderboard only sees this process's completions, so it is reloaded
+    afterwards to pick up the other replicas' too.
+    """
+    if db:
+        await db.rollup_completions()
+        await db.load_leaderboard()
+
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set the timezone the daily delivery time is interpreted in."""
+    if not db:
+        await update.message.reply_text("Sorry, the subscription service is currently unavailable.")
+        return
+
+    user_id = update.effective_user.id
+    zone_name = context.args[0] if context.args else None
+    if not zone_name or not get_zone(zone_name):
+        await update.message.reply_text(
+            "Please give me a timezone name, for example: /timezone Europe/Berlin or /timezone America/New_York"
+        )
+        return
+    if not await db.is_subscribed(user_id):
+        await update.message.reply_text("You're not subscribed yet - use /subscribe first!")
+        return
+    if await db.set_delivery_time(user_id, timezone=zone_name):
+        await update.message.reply_text(f"🌍 Your timezone is now {zone_name}.")
+    else:
+        await update.message.reply_text("Sorry, I couldn't update your timezone. Please try again later!")
+
+async def settime(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set the local time the daily affirmation and quest is delivered."""
+    if not db:
+        await update.message.reply_text("Sorry, the subscription service is currently unavailable.")
+        return
+
+    user_id = update.effective_user.id
+    try:
+        delivery_time = datetime.strptime(context.args[0], "%H:%M")
+    except (IndexError, ValueError):
+        await update.message.reply_text("Please give me a time in 24h format, for example: /settime 07:30")
+        return
+    if not await db.is_subscribed(user_id):
+        await update.message.reply_text("You're not subscribed yet - use /subscribe first!")
+        return
+    if await db.set_delivery_time(user_id, delivery_minute=delivery_time.hour * 60 + delivery_time.minute):
+        zone = db.schedule.get(user_id)
+        zone_name = zone[0].key if zone else DEFAULT_TIMEZONE
+        await update.message.reply_text(
+            f"⏰ Your daily quest will arrive at {delivery_time:%H:%M} ({zone_name})."
+        )
+    else:
+        await update.message.reply_text("Sorry, I couldn't update your delivery time. Please try again later!")
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
     help_text = (
         "🌟 Daily Quests & Affirmations Help 🌟\n\n"
-        "Every morning at 9 AM, subscribers receive:\n"
+        "Every morning at 9 AM (or the time you pick), subscribers receive:\n"
         "• A personal affirmation to boost their day\n"
         "• An interesting quest to make life more meaningful\n\n"
         "Commands:\n"
         "• /start - Start the bot\n"
         "• /subscribe - Get daily messages\n"
         "• /unsubscribe - Stop daily messages\n"
+        "• /timezone Europe/Berlin - Set your timezone\n"
+        "• /settime 07:30 - Choose when your daily message arrives\n"
         "• /quest - Get an instant affirmation and quest\n"
         "• /today - Get today's affirmation and quest\n"
         "• /help - Show this help message"
@@ -191,15 +510,28 @@ async def db_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         logger.info("Attempting to get subscriber count")
         # Test database connection by getting subscriber count
-        subscriber_count = len(db.get_all_subscribers())
+        subscriber_count = len(await db.get_all_subscribers())
         logger.info(f"Successfully got subscriber count: {subscriber_count}")
+        cache_lines = "".join(
+            f"• {name}: {stats['hits']} hits / {stats['misses']} misses ({stats['hit_rate']:.0%})\n"
+            for name, stats in db.cache_stats().items()
+        )
+        library_stats = quest_library.stats()
+        admission_stats = quest_admission.stats()
         await update.message.reply_text(
             "✅ Database connection is working!\n\n"
             f"📊 Current subscriber count: {subscriber_count}\n\n"
             "The database will store:\n"
             "• Subscriber Telegram IDs\n"
             "• When each person subscribed\n\n"
-            "This helps the bot remember subscribers even if it restarts!"
+            "This helps the bot remember subscribers even if it restarts!\n\n"
+            f"🗄 Cache:\n{cache_lines}\n"
+            f"📚 Quest library: {library_stats['quests']} quests across {library_stats['moods']} moods "
+            f"({library_stats['hits']} served from the library, {library_stats['generated']} generated)\n\n"
+            f"🚦 /quest: {admission_stats['admitted']} admitted, {admission_stats['in_flight']} in flight, "
+            f"{admission_stats['rate_limited']} rate limited, {admission_stats['saturated']} shed at capacity"
+            + (f"\n\n🤖 OpenAI circuit {ai.breaker.state} (opened {ai.breaker.opened} times, "
+               f"{ai.breaker.rejected} calls skipped, {ai.hedges} hedged)" if ai else "")
         )
     except Exception as e:
         logger.error(f"Error checking database status: {e}")
@@ -226,13 +558,13 @@ async def mood_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = user.first_name
     last_name = user.last_name if hasattr(user, 'last_name') else None
     username = user.username if hasattr(user, 'username') else None
-    db.update_user_info(user_id, first_name, last_name, username)
+    await db.update_user_info(user_id, first_name, last_name, username)
 
     mood = update.message.text
     if mood not in MOODS:
         await update.message.reply_text("Please choose a mood using the buttons.")
         return 1
-    db.set_mood(user_id, mood)
+    await db.set_mood(user_id, mood)
     await update.message.reply_text(f"Your mood is now set to: {mood}", reply_markup=ReplyKeyboardMarkup([["/quest", "/setmood"]], resize_keyboard=True))
     return ConversationHandler.END
 
@@ -243,7 +575,6 @@ async def quest_completed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = user.first_name
     last_name = user.last_name if hasattr(user, 'last_name') else None
     username = user.username if hasattr(user, 'username') else None
-    db.update_user_info(user_id, first_name, last_name, username)
 
     is_reply = update.message.reply_to_message is not None
     # Optionally: Check if the replied-to message was sent by the bot and contains a quest (could check for emoji or keywords)
@@ -253,72 +584,165 @@ async def quest_completed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         special = False
 
-    db.increment_quests_completed(user_id)
-    new_total = db.get_quests_completed(user_id)
+    new_total, is_leader = await db.complete_quest(user_id, first_name, last_name, username)
 
     if special:
         await update.message.reply_text(f"🔥 You completed a quest you received from me! That's <b>{new_total}</b> total quests! Legendary!", parse_mode="HTML")
     else:
         await update.message.reply_text(f"🎉 Quest completed! You have now completed <b>{new_total}</b> quests!", parse_mode="HTML")
 
-    leaderboard = db.get_leaderboard(limit=1)
-    if new_total > 0 and leaderboard and leaderboard[0][0] == user_id:
+    if new_total > 0 and is_leader:
         await update.message.reply_text("🏆 You're at the top of the leaderboard! Keep it up!")
 
+# Rendered top-10, reused until the in-memory leaderboard's top rows change
+leaderboard_html_cache = {}
+
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display the top users by quests completed."""
     if not db:
         await update.message.reply_text("Leaderboard is currently unavailable.")
         return
-    leaderboard = db.get_leaderboard(limit=10)
-    if not leaderboard:
-        await update.message.reply_text("No leaderboard data yet!")
-        return
-    lines = ["🏆 <b>Quest Leaderboard</b> 🏆\n"]
-    for idx, row in enumerate(leaderboard, 1):
-        user_id, first_name, username, quests_completed = row
-        display = f"@{username}" if username else (first_name or "Anonymous")
-        lines.append(f"{idx}. {display}: <b>{quests_completed or 0}</b> quests")
-    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
-
-
-def main():
-    """Start the bot."""
-    # Create the Application
-    application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+    version = db.leaderboard.version if db.leaderboard.loaded else None
+    html = leaderboard_html_cache.get(version)
+    if html is None:
+        leaderboard = await db.get_leaderboard(limit=10)
+        if not leaderboard:
+            await update.message.reply_text("No leaderboard data yet!")
+            return
+        lines = ["🏆 <b>Quest Leaderboard</b> 🏆\n"]
+        for idx, row in enumerate(leaderboard, 1):
+            user_id, first_name, username, quests_completed = row
+            display = f"@{username}" if username else (first_name or "Anonymous")
+            lines.append(f"{idx}. {display}: <b>{quests_completed or 0}</b> quests")
+        html = "\n".join(lines)
+        if version is not None:
+            leaderboard_html_cache.clear()
+            leaderboard_html_cache[version] = html
+
+    rank = await db.get_rank(update.effective_user.id)
+    if rank and rank > 10:
+        html += f"\n\nYou're currently #{rank}. Keep questing!"
+    await update.message.reply_text(html, parse_mode="HTML")
+
+
+async def post_init(application: Application):
+    """Make sure the database tables exist before handling updates."""
+    global metrics_server
+    if METRICS_PORT:
+        metrics_server = start_server()
+    if db:
+        await db.create_subscribers_table()  # Ensure the subscribers table exists
+        await db.ensure_subscribers_schema()
+        await db.create_delivery_queue_table()  # Pre-generated daily messages and delivery ledger
+        await db.ensure_delivery_queue_schema()
+        await db.create_quest_completions_table()  # Completion event log
+        await db.create_daily_messages_table()  # Shared /today message per date
+        await db.create_quest_library_tables()  # Reusable quests and who has seen them
+        await db.create_delivery_leases_table()  # Delivery chunks shared between replicas
+        # Fold completions left over from the previous run before loading the counters
+        await db.rollup_completions()
+        await db.load_leaderboard()
+        await db.refresh_delivery_slots()
+        await db.load_schedule()
+        await quest_library.load()
+
+async def post_shutdown(application: Application):
+    """Release shared connection pools when the bot stops."""
+    if metrics_server:
+        metrics_server.stop()
+    if ai:
+        await ai.close()
+    if db:
+        await db.flush_user_info()
+        await db.flush_completions()
+        await db.rollup_completions()
+        await quest_library.flush_seen()
+        await db.close()
+
+
+def command(name: str, callback) -> CommandHandler:
+    """A CommandHandler whose latency and errors are recorded in the metrics."""
+    return CommandHandler(name, timed_handler(name, callback))
+
+
+def build_application() -> Application:
+    """Create the Application with all handlers and scheduled jobs registered."""
+    # Size the HTTP pool for the broadcast workers plus headroom for interactive replies
+    builder = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        .connection_pool_size(BROADCAST_CONCURRENCY + 16)
+        .pool_timeout(30)
+        # Handle users' updates concurrently so one slow /quest doesn't hold up everyone else,
+        # while each user's own updates stay in order for the /setmood conversation
+        .concurrent_updates(PerUserUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        # Talk to a self-hosted Bot API server (or a local fake one) instead of api.telegram.org
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    application = builder.build()
 
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("subscribe", subscribe))
-    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
-    application.add_handler(CommandHandler("quest", quest))
-    application.add_handler(CommandHandler("today", today))
-    application.add_handler(CommandHandler("dbstatus", db_status))
-    application.add_handler(CommandHandler("leaderboard", leaderboard))
-    application.add_handler(CommandHandler("quest_completed", quest_completed))
+    application.add_handler(command("start", start))
+    application.add_handler(command("help", help_command))
+    application.add_handler(command("subscribe", subscribe))
+    application.add_handler(command("unsubscribe", unsubscribe))
+    application.add_handler(command("quest", quest))
+    application.add_handler(command("today", today))
+    application.add_handler(command("dbstatus", db_status))
+    application.add_handler(command("leaderboard", leaderboard))
+    application.add_handler(command("quest_completed", quest_completed))
+    application.add_handler(command("timezone", set_timezone))
+    application.add_handler(command("settime", settime))
 
     # Mood selection conversation handler
     mood_conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("setmood", setmood)],
+        entry_points=[command("setmood", setmood)],
         states={
-            1: [MessageHandler(filters.TEXT & ~filters.COMMAND, mood_selection)]
+            1: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler("setmood_choice", mood_selection))]
         },
         fallbacks=[]
     )
     application.add_handler(mood_conv_handler)
 
-    # Set up the daily job (9 AM)
     job_queue = application.job_queue
-    job_queue.run_daily(
-        send_daily_messages,
-        time=time(hour=9, minute=0),  # 9:00 AM
-        days=(0, 1, 2, 3, 4, 5, 6)  # Every day
-    )
+    job_queue.run_repeating(flush_profile_updates, interval=PROFILE_FLUSH_INTERVAL)
+    job_queue.run_repeating(flush_completions, interval=COMPLETION_FLUSH_INTERVAL)
+    job_queue.run_repeating(rollup_completions, interval=COMPLETION_ROLLUP_INTERVAL)
+    job_queue.run_repeating(flush_seen_quests, interval=QUEST_SEEN_FLUSH_INTERVAL)
+
+    # Pre-generate upcoming quests every hour so the scheduler only reads and sends
+    job_queue.run_repeating(pregenerate_daily_messages, interval=3600, first=10)
+
+    # Deliver each subscriber's quest at their own local time, checking every minute
+    job_queue.run_repeating(send_daily_messages, interval=60, first=60 - datetime.now().second)
+    job_queue.run_repeating(refresh_delivery_schedule, interval=SCHEDULE_REFRESH_INTERVAL,
+                            first=SCHEDULE_REFRESH_INTERVAL)
+    return application
+
+
+def main():
+    """Start the bot."""
+    application = build_application()
 
     # Start the Bot
-    application.run_polling()
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us (up to WEBHOOK_MAX_CONNECTIONS at a time) instead
+        # of us long-polling for them; requests without the secret token are rejected
+        url_path = urlsplit(WEBHOOK_URL).path.lstrip('/')
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
@@ -1,26 +1,122 @@
-from sqlalchemy import create_engine, text
-from typing import List
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from collections import Counter, OrderedDict
+from datetime import date, datetime, timedelta, timezone
+import asyncio
 import os
 import logging
 import traceback
+from urllib.parse import parse_qsl, urlencode
+from leaderboard import Leaderboard
+from ttl_cache import TTLCache, MISSING
+from delivery_schedule import DeliverySchedule, DEFAULT_TIMEZONE, DEFAULT_DELIVERY_MINUTE
+from metrics import track_engine
+
+# Rows fetched per round-trip when streaming the subscriber roster
+ROSTER_BATCH_SIZE = int(os.getenv('ROSTER_BATCH_SIZE', '1000'))
+# Profiles remembered to skip redundant update_user_info writes, and how often changes are flushed
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_FLUSH_INTERVAL = float(os.getenv('PROFILE_FLUSH_INTERVAL', '30'))
+# Read-through cache for get_mood / is_subscribed, invalidated by our own writers. Other
+# replicas' writes only show up once an entry expires, so with several replicas a mood
+# changed elsewhere can be up to STATE_CACHE_TTL old; lower it if that matters
+STATE_CACHE_SIZE = int(os.getenv('STATE_CACHE_SIZE', '10000'))
+STATE_CACHE_TTL = float(os.getenv('STATE_CACHE_TTL', '300'))
+# Buffered quest completions are bulk-inserted every flush interval and folded into
+# subscribers.quests_completed every rollup interval
+COMPLETION_FLUSH_INTERVAL = float(os.getenv('COMPLETION_FLUSH_INTERVAL', '2'))
+COMPLETION_ROLLUP_INTERVAL = float(os.getenv('COMPLETION_ROLLUP_INTERVAL', '60'))
+COMPLETION_ROLLUP_BATCH = int(os.getenv('COMPLETION_ROLLUP_BATCH', '10000'))
 
 logger = logging.getLogger(__name__)
 
-class QuestBotDB:
+def async_database_url(db_url: str) -> str:
+    """Rewrite a postgres:// or postgresql:// URL to use the asyncpg driver.
+
+    Query parameters are passed to asyncpg.connect as keyword arguments, so libpq's sslmode
+    (e.g. ?sslmode=require from a hosted database) becomes asyncpg's ssl, which takes the
+    same values.
+    """
+    scheme, _, rest = db_url.partition('://')
+    if scheme in ('postgres', 'postgresql') or scheme.startswith('postgresql+'):
+        rest, _, query = rest.partition('?')
+        params = parse_qsl(query, keep_blank_values=True)
+        has_ssl = any(key == 'ssl' for key, value in params)
+        params = [('ssl' if key == 'sslmode' else key, value) for key, value in params
+                  if not (key == 'sslmode' and has_ssl)]
+        return f"postgresql+asyncpg://{rest}" + (f"?{urlencode(params)}" if params else "")
+    return db_url
+
+# Sets delivery_utc_minute (the UTC minute of the day a subscriber's delivery falls on today,
+# in their timezone) and delivery_utc_offset (local minus UTC time, in minutes) for the rows
+# matching {where}. Unknown timezones fall back to DEFAULT_TIMEZONE, as in DeliverySchedule.
+_DELIVERY_SLOT_UPDATE = """
+    WITH local AS (
+        SELECT s.user_id, COALESCE(z.name, :default_timezone) AS zone,
+               CAST(now() AT TIME ZONE COALESCE(z.name, :default_timezone) AS DATE)
+                   + COALESCE(s.delivery_minute, :default_minute) * INTERVAL '1 minute' AS local_time
+        FROM subscribers s
+        LEFT JOIN pg_timezone_names z ON z.name = s.timezone
+        WHERE {where}
+    ), utc AS (
+        SELECT user_id, local_time, (local_time AT TIME ZONE zone) AT TIME ZONE 'UTC' AS utc_time
+        FROM local
+    ), slots AS (
+        SELECT user_id,
+               CAST(EXTRACT(HOUR FROM utc_time) * 60 + EXTRACT(MINUTE FROM utc_time) AS SMALLINT) AS utc_minute,
+               CAST(EXTRACT(EPOCH FROM local_time - utc_time) / 60 AS SMALLINT) AS utc_offset
+        FROM utc
+    )
+    UPDATE subscribers s
+    SET delivery_utc_minute = slots.utc_minute, delivery_utc_offset = slots.utc_offset
+    FROM slots
+    WHERE s.user_id = slots.user_id
+    AND (s.delivery_utc_minute IS DISTINCT FROM slots.utc_minute
+         OR s.delivery_utc_offset IS DISTINCT FROM slots.utc_offset)
+"""
+
+
+def _delivery_slot_params() -> Dict[str, object]:
+    return {"default_timezone": DEFAULT_TIMEZONE, "default_minute": DEFAULT_DELIVERY_MINUTE}
+
+def _utc_naive(moment: datetime) -> datetime:
+    """Convert an aware datetime to the naive UTC form stored in TIMESTAMP columns."""
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+class AsyncQuestBotDB:
+    """The bot's database on an asyncpg engine, with in-memory caches in front of the hot reads."""
+
     def __init__(self):
+        # Last written (first_name, last_name, username) per user, and changes waiting to be flushed
+        self._profiles = OrderedDict()
+        self._dirty_profiles = {}
+        # Loaded by load_leaderboard after every rollup, and kept up to date by the writers in between
+        self.leaderboard = Leaderboard()
+        self._mood_cache = TTLCache(STATE_CACHE_SIZE, STATE_CACHE_TTL)
+        self._subscribed_cache = TTLCache(STATE_CACHE_SIZE, STATE_CACHE_TTL)
+        # Loaded by load_schedule and kept up to date by the subscription and delivery-time writers
+        self.schedule = DeliverySchedule()
+        # (user_id, completed_at) events waiting for flush_completions; the lock keeps a flush
+        # from moving events into the log while load_leaderboard is counting them
+        self._pending_completions = []
+        self._completions_lock = asyncio.Lock()
         # Try Railway's DATABASE_URL first, then fall back to QUEST_BOT_DATABASE_URL
         db_url = os.getenv('DATABASE_URL') or os.getenv('QUEST_BOT_DATABASE_URL')
         if not db_url:
             logger.warning("No database URL found - database features will be disabled")
             return
         try:
-            self.engine = create_engine(db_url)
+            self.engine = create_async_engine(async_database_url(db_url))
+            track_engine(self.engine, "quest_bot")
             logger.info("Successfully connected to Quest Bot database")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             self.engine = None
 
-    def create_subscribers_table(self):
+    async def create_subscribers_table(self):
         """Create the subscribers table if it doesn't exist, with all required columns."""
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot create subscribers table")
@@ -35,12 +131,21 @@ class QuestBotDB:
                     first_name TEXT,
                     last_name TEXT,
                     username TEXT,
-                    quests_completed INTEGER DEFAULT 0
+                    quests_completed INTEGER DEFAULT 0,
+                    timezone TEXT,
+                    delivery_minute SMALLINT,
+                    delivery_utc_minute SMALLINT,
+                    delivery_utc_offset SMALLINT
                 );
             """)
-            with self.engine.connect() as conn:
-                conn.execute(query)
-                conn.commit()
+            index = text("""
+                CREATE INDEX IF NOT EXISTS idx_subscribers_leaderboard
+                ON subscribers (quests_completed DESC NULLS LAST, user_id ASC)
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query)
+                await conn.execute(index)
+                await conn.commit()
             logger.info("Subscribers table checked/created successfully.")
             return True
         except Exception as e:
@@ -48,33 +153,204 @@ class QuestBotDB:
             logger.error(traceback.format_exc())
             return False
 
-    def ensure_subscribers_schema(self):
+    async def create_delivery_queue_table(self):
+        """Create the delivery_queue table holding pre-generated daily messages, if it doesn't exist."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot create delivery_queue table")
+            return False
+        try:
+            query = text("""
+                CREATE TABLE IF NOT EXISTS delivery_queue (
+                    delivery_date DATE NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    message TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    sent_at TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (delivery_date, user_id)
+                );
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query)
+                await conn.commit()
+            logger.info("delivery_queue table checked/created successfully.")
+            return True
+        except Exception as e:
+            logger.error(f"Error creating delivery_queue table: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def create_daily_messages_table(self):
+        """Create the daily_messages table holding the shared /today message for each date."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot create daily_messages table")
+            return False
+        try:
+            query = text("""
+                CREATE TABLE IF NOT EXISTS daily_messages (
+                    message_date DATE PRIMARY KEY,
+                    message TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query)
+                await conn.commit()
+            logger.info("daily_messages table checked/created successfully.")
+            return True
+        except Exception as e:
+            logger.error(f"Error creating daily_messages table: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def create_quest_library_tables(self):
+        """Create the quest_library table and the per-user quest_seen bitmaps if they don't exist."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot create quest library tables")
+            return False
+        try:
+            async with self.engine.connect() as conn:
+                await conn.execute(text("""
+                    CREATE TABLE IF NOT EXISTS quest_library (
+                        id SERIAL PRIMARY KEY,
+                        mood TEXT NOT NULL,
+                        message TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """))
+                await conn.execute(text("CREATE INDEX IF NOT EXISTS idx_quest_library_mood ON quest_library (mood)"))
+                # Bit n of seen is set once the user has been served quest_library id n
+                await conn.execute(text("""
+                    CREATE TABLE IF NOT EXISTS quest_seen (
+                        user_id BIGINT PRIMARY KEY,
+                        seen BYTEA NOT NULL
+                    );
+                """))
+                await conn.commit()
+            logger.info("quest_library and quest_seen tables checked/created successfully.")
+            return True
+        except Exception as e:
+            logger.error(f"Error creating quest library tables: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def create_quest_completions_table(self):
+        """Create the append-only quest_completions event log if it doesn't exist."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot create quest_completions table")
+            return False
+        try:
+            query = text("""
+                CREATE TABLE IF NOT EXISTS quest_completions (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    completed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    rolled_up BOOLEAN NOT NULL DEFAULT FALSE
+                );
+            """)
+            indexes = [
+                text("CREATE INDEX IF NOT EXISTS idx_quest_completions_pending ON quest_completions (id) WHERE NOT rolled_up"),
+                text("CREATE INDEX IF NOT EXISTS idx_quest_completions_user ON quest_completions (user_id, completed_at)"),
+            ]
+            async with self.engine.connect() as conn:
+                await conn.execute(query)
+                for index in indexes:
+                    await conn.execute(index)
+                await conn.commit()
+            logger.info("quest_completions table checked/created successfully.")
+            return True
+        except Exception as e:
+            logger.error(f"Error creating quest_completions table: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def create_delivery_leases_table(self):
+        """Create the delivery_leases table used to split deliveries between bot processes."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot create delivery_leases table")
+            return False
+        try:
+            query = text("""
+                CREATE TABLE IF NOT EXISTS delivery_leases (
+                    slot TIMESTAMP NOT NULL,
+                    shard INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    owner TEXT,
+                    lease_expires_at TIMESTAMP,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (slot, shard)
+                );
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query)
+                await conn.commit()
+            logger.info("delivery_leases table checked/created successfully.")
+            return True
+        except Exception as e:
+            logger.error(f"Error creating delivery_leases table: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def ensure_subscribers_schema(self):
         """Ensure all required columns exist in the subscribers table. Adds any missing columns."""
         required_columns = {
             'mood': "TEXT",
             'first_name': "TEXT",
             'last_name': "TEXT",
             'username': "TEXT",
-            'quests_completed': "INTEGER DEFAULT 0"
+            'quests_completed': "INTEGER DEFAULT 0",
+            'timezone': "TEXT",
+            'delivery_minute': "SMALLINT",
+            'delivery_utc_minute': "SMALLINT",
+            'delivery_utc_offset': "SMALLINT"
         }
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot check subscribers schema")
             return
         try:
-            with self.engine.connect() as conn:
-                result = conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='subscribers'"))
+            async with self.engine.connect() as conn:
+                result = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='subscribers'"))
                 existing_columns = {row[0] for row in result}
                 for col, coltype in required_columns.items():
                     if col not in existing_columns:
                         logger.info(f"Adding missing column '{col}' to subscribers table.")
                         alter = text(f"ALTER TABLE subscribers ADD COLUMN {col} {coltype}")
-                        conn.execute(alter)
-                        conn.commit()
+                        await conn.execute(alter)
+                        await conn.commit()
+                # Created here rather than with the table, since older tables only just got the column
+                await conn.execute(text("""
+                    CREATE INDEX IF NOT EXISTS idx_subscribers_delivery_utc_minute
+                    ON subscribers (delivery_utc_minute)
+                """))
+                await conn.commit()
         except Exception as e:
             logger.error(f"Error ensuring subscribers schema: {e}")
             logger.error(traceback.format_exc())
 
-    def add_subscriber(self, user_id: int, first_name: str = None, last_name: str = None, username: str = None) -> tuple[bool, str | None]:
+    async def ensure_delivery_queue_schema(self):
+        """Add the delivery ledger columns to a delivery_queue table created before they existed."""
+        required_columns = {
+            'status': "TEXT NOT NULL DEFAULT 'queued'",
+            'sent_at': "TIMESTAMP"
+        }
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot check delivery_queue schema")
+            return
+        try:
+            async with self.engine.connect() as conn:
+                result = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='delivery_queue'"))
+                existing_columns = {row[0] for row in result}
+                for col, coltype in required_columns.items():
+                    if col not in existing_columns:
+                        logger.info(f"Adding missing column '{col}' to delivery_queue table.")
+                        alter = text(f"ALTER TABLE delivery_queue ADD COLUMN {col} {coltype}")
+                        await conn.execute(alter)
+                        await conn.commit()
+        except Exception as e:
+            logger.error(f"Error ensuring delivery_queue schema: {e}")
+            logger.error(traceback.format_exc())
+
+    async def add_subscriber(self, user_id: int, first_name: str = None, last_name: str = None, username: str = None) -> tuple[bool, str | None]:
         """Add a new subscriber. Returns (success, error_message)."""
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot add subscriber")
@@ -85,25 +361,53 @@ class QuestBotDB:
                 VALUES (:user_id, :first_name, :last_name, :username)
                 ON CONFLICT (user_id) DO NOTHING
             """)
-            with self.engine.connect() as conn:
-                conn.execute(query, {
+            slot = text(_DELIVERY_SLOT_UPDATE.format(where="s.user_id = :user_id"))
+            async with self.engine.connect() as conn:
+                await conn.execute(query, {
                     "user_id": user_id,
                     "first_name": first_name,
                     "last_name": last_name,
                     "username": username
                 })
-                conn.commit()
+                await conn.execute(slot, {"user_id": user_id, **_delivery_slot_params()})
+                await conn.commit()
+            self._invalidate_state(user_id)
+            if self.leaderboard.loaded:
+                self.leaderboard.add(user_id, first_name, username)
+            if self.schedule.loaded and self.schedule.get(user_id) is None:
+                self.schedule.add(user_id)
             return True, None
         except Exception as e:
             logger.error(f"Error adding subscriber {user_id}: {e}")
             logger.error(traceback.format_exc())
             return False, str(e)
 
-    def update_user_info(self, user_id: int, first_name: str = None, last_name: str = None, username: str = None):
-        """Update a user's first_name, last_name, or username."""
+    async def update_user_info(self, user_id: int, first_name: str = None, last_name: str = None, username: str = None):
+        """Record a user's first_name, last_name, or username.
+
+        Unchanged profiles are skipped; changes are buffered and written by flush_user_info.
+        """
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot update user info")
             return False
+        profile = (first_name, last_name, username)
+        if self._profiles.get(user_id) != profile:
+            self._dirty_profiles[user_id] = profile
+            self.leaderboard.set_profile(user_id, first_name, username)
+        self._remember_profile(user_id, profile)
+        return True
+
+    def _remember_profile(self, user_id: int, profile: tuple):
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > PROFILE_CACHE_SIZE:
+            self._profiles.popitem(last=False)
+
+    async def flush_user_info(self) -> bool:
+        """Write all buffered profile changes in a single batched UPDATE."""
+        if not hasattr(self, 'engine') or not self.engine or not self._dirty_profiles:
+            return True
+        dirty, self._dirty_profiles = self._dirty_profiles, {}
         try:
             query = text("""
                 UPDATE subscribers
@@ -112,69 +416,196 @@ class QuestBotDB:
                     username = COALESCE(:username, username)
                 WHERE user_id = :user_id
             """)
-            with self.engine.connect() as conn:
-                conn.execute(query, {
+            async with self.engine.connect() as conn:
+                await conn.execute(query, [
+                    {"user_id": user_id, "first_name": first_name, "last_name": last_name, "username": username}
+                    for user_id, (first_name, last_name, username) in dirty.items()
+                ])
+                await conn.commit()
+            logger.info(f"Flushed {len(dirty)} profile updates.")
+            return True
+        except Exception as e:
+            logger.error(f"Error flushing {len(dirty)} profile updates: {e}")
+            logger.error(traceback.format_exc())
+            # Keep the failed changes for the next flush unless they were superseded meanwhile
+            for user_id, profile in dirty.items():
+                self._dirty_profiles.setdefault(user_id, profile)
+            return False
+
+    async def complete_quest(self, user_id: int, first_name: str = None, last_name: str = None,
+                             username: str = None) -> Tuple[int, bool]:
+        """Record a completed quest and return (new_total, is_leader).
+
+        is_leader means the user is now first on the leaderboard. Once the leaderboard is
+        loaded, users who already have a row are served from memory: the completion goes to
+        the event buffer and the counter is rolled up later, so the hot subscribers row isn't
+        locked on every completion.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot complete quest")
+            return 0, False
+        if not self.leaderboard.loaded or self.leaderboard.get_count(user_id) is None:
+            return await self._complete_quest_now(user_id, first_name, last_name, username)
+        self._pending_completions.append((user_id, datetime.utcnow()))
+        await self.update_user_info(user_id, first_name, last_name, username)
+        new_total = self.leaderboard.increment(user_id)
+        return new_total, self.leaderboard.rank(user_id) == 1
+
+    async def _complete_quest_now(self, user_id: int, first_name: str = None, last_name: str = None,
+                                  username: str = None) -> Tuple[int, bool]:
+        """Record a completed quest in one statement, creating the user's row if needed."""
+        try:
+            # The leader check reads the pre-update snapshot, which is fine: the user's own row
+            # is excluded and nobody else's count changes in this statement
+            query = text("""
+                WITH completed AS (
+                    INSERT INTO subscribers (user_id, first_name, last_name, username, quests_completed)
+                    VALUES (:user_id, :first_name, :last_name, :username, 1)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        quests_completed = COALESCE(subscribers.quests_completed, 0) + 1,
+                        first_name = COALESCE(EXCLUDED.first_name, subscribers.first_name),
+                        last_name = COALESCE(EXCLUDED.last_name, subscribers.last_name),
+                        username = COALESCE(EXCLUDED.username, subscribers.username)
+                    RETURNING user_id, quests_completed
+                )
+                SELECT c.quests_completed, NOT EXISTS (
+                    SELECT 1 FROM subscribers s
+                    WHERE s.user_id <> c.user_id
+                    AND (s.quests_completed > c.quests_completed
+                         OR (s.quests_completed = c.quests_completed AND s.user_id < c.user_id))
+                )
+                FROM completed c
+            """)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {
                     "user_id": user_id,
                     "first_name": first_name,
                     "last_name": last_name,
                     "username": username
                 })
-                conn.commit()
-            return True
+                new_total, is_leader = result.fetchone()
+                await conn.commit()
+            self._subscribed_cache.invalidate(user_id)
+            self._dirty_profiles.pop(user_id, None)
+            self._remember_profile(user_id, (first_name, last_name, username))
+            if self.leaderboard.loaded:
+                self.leaderboard.set(user_id, new_total)
+                self.leaderboard.set_profile(user_id, first_name, username)
+                # Other users' counters may still be waiting in the event log, so memory wins
+                is_leader = self.leaderboard.rank(user_id) == 1
+            return new_total, is_leader
         except Exception as e:
-            logger.error(f"Error updating user info for {user_id}: {e}")
+            logger.error(f"Error completing quest for {user_id}: {e}")
             logger.error(traceback.format_exc())
-            return False
+            return 0, False
 
-    def increment_quests_completed(self, user_id: int):
-        """Increment quests_completed for a user."""
+    async def flush_completions(self) -> bool:
+        """Bulk-insert buffered quest completions into the event log."""
+        if not hasattr(self, 'engine') or not self.engine or not self._pending_completions:
+            return True
+        async with self._completions_lock:
+            pending, self._pending_completions = self._pending_completions, []
+            try:
+                query = text("""
+                    INSERT INTO quest_completions (user_id, completed_at)
+                    VALUES (:user_id, :completed_at)
+                """)
+                async with self.engine.connect() as conn:
+                    await conn.execute(query, [
+                        {"user_id": user_id, "completed_at": completed_at} for user_id, completed_at in pending
+                    ])
+                    await conn.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Error flushing {len(pending)} quest completions: {e}")
+                logger.error(traceback.format_exc())
+                self._pending_completions = pending + self._pending_completions
+                return False
+
+    async def rollup_completions(self) -> int:
+        """Fold logged completions into subscribers.quests_completed. Returns the number of events folded."""
         if not hasattr(self, 'engine') or not self.engine:
-            logger.warning("No database connection - cannot increment quests_completed")
-            return False
+            logger.warning("No database connection - cannot roll up quest completions")
+            return 0
         try:
-            logger.info(f"Incrementing quests_completed for user_id {user_id}...")
+            # SKIP LOCKED lets several processes roll up at once without double counting
             query = text("""
-                INSERT INTO subscribers (user_id, quests_completed)
-                VALUES (:user_id, 1)
-                ON CONFLICT (user_id) DO UPDATE SET quests_completed = subscribers.quests_completed + 1
+                WITH batch AS (
+                    UPDATE quest_completions SET rolled_up = TRUE
+                    WHERE id IN (
+                        SELECT id FROM quest_completions
+                        WHERE NOT rolled_up
+                        ORDER BY id
+                        LIMIT :limit
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING user_id
+                ), counts AS (
+                    SELECT user_id, COUNT(*) AS completed FROM batch GROUP BY user_id
+                ), updated AS (
+                    -- Only existing rows: completions of users who have since unsubscribed
+                    -- must not bring their subscribers row back
+                    UPDATE subscribers
+                    SET quests_completed = COALESCE(subscribers.quests_completed, 0) + counts.completed
+                    FROM counts
+                    WHERE subscribers.user_id = counts.user_id
+                    RETURNING 1
+                )
+                SELECT COALESCE(SUM(completed), 0) FROM counts
             """)
-            with self.engine.connect() as conn:
-                conn.execute(query, {"user_id": user_id})
-                conn.commit()
-            logger.info(f"quests_completed incremented for user_id {user_id}.")
-            return True
+            total = 0
+            async with self.engine.connect() as conn:
+                while True:
+                    result = await conn.execute(query, {"limit": COMPLETION_ROLLUP_BATCH})
+                    folded = result.scalar()
+                    await conn.commit()
+                    total += folded
+                    if folded < COMPLETION_ROLLUP_BATCH:
+                        break
+            if total:
+                logger.info(f"Rolled up {total} quest completions.")
+            return total
         except Exception as e:
-            logger.error(f"Error incrementing quests_completed for {user_id}: {e}")
+            logger.error(f"Error rolling up quest completions: {e}")
             logger.error(traceback.format_exc())
-            return False
+            return 0
 
-    def get_quests_completed(self, user_id: int) -> int:
-        """Get the number of quests completed by a user."""
+    async def get_completion_streak(self, user_id: int) -> int:
+        """Number of consecutive days, ending today or yesterday, on which the user completed a quest."""
         if not hasattr(self, 'engine') or not self.engine:
-            logger.warning("No database connection - cannot fetch quests_completed")
+            logger.warning("No database connection - cannot get completion streak")
             return 0
         try:
-            logger.info(f"Fetching quests_completed for user_id {user_id}...")
-            query = text("SELECT quests_completed FROM subscribers WHERE user_id = :user_id")
-            with self.engine.connect() as conn:
-                result = conn.execute(query, {"user_id": user_id})
-                row = result.fetchone()
-                if row and row[0] is not None:
-                    logger.info(f"quests_completed for user_id {user_id}: {row[0]}")
-                    return row[0]
-                else:
-                    logger.info(f"No quests_completed found for user_id {user_id}, returning 0.")
-                    return 0
+            query = text("""
+                SELECT DISTINCT CAST(completed_at AS DATE)
+                FROM quest_completions
+                WHERE user_id = :user_id
+            """)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"user_id": user_id})
+                days = {row[0] for row in result}
+            days.update(completed_at.date() for pending_user_id, completed_at in self._pending_completions
+                        if pending_user_id == user_id)
+            day = datetime.utcnow().date()
+            if day not in days:
+                day -= timedelta(days=1)
+            streak = 0
+            while day in days:
+                streak += 1
+                day -= timedelta(days=1)
+            return streak
         except Exception as e:
-            logger.error(f"Error fetching quests_completed for {user_id}: {e}")
+            logger.error(f"Error getting completion streak for {user_id}: {e}")
             logger.error(traceback.format_exc())
             return 0
 
-    def get_leaderboard(self, limit: int = 10):
+    async def get_leaderboard(self, limit: int = 10):
         """Return a list of top users by quests_completed."""
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot get leaderboard")
             return []
+        if self.leaderboard.loaded:
+            return self.leaderboard.top(limit)
         try:
             query = text("""
                 SELECT user_id, first_name, username, quests_completed
@@ -182,15 +613,76 @@ class QuestBotDB:
                 ORDER BY quests_completed DESC NULLS LAST, user_id ASC
                 LIMIT :limit
             """)    
-            with self.engine.connect() as conn:
-                result = conn.execute(query, {"limit": limit})
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"limit": limit})
                 return result.fetchall()
         except Exception as e:
             logger.error(f"Error fetching leaderboard: {e}")
             logger.error(traceback.format_exc())
             return []
 
-    def set_mood(self, user_id: int, mood: str) -> bool:
+    async def load_leaderboard(self) -> bool:
+        """Load every user's quest count into the in-memory leaderboard.
+
+        Counts include completions still waiting in the event log, whichever replica logged
+        them, and this process's buffered ones, so reloading after a rollup brings the board
+        back in line with the other replicas without losing anything not yet written.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot load leaderboard")
+            return False
+        try:
+            query = text("""
+                SELECT s.user_id, s.first_name, s.username,
+                       COALESCE(s.quests_completed, 0) + COALESCE(c.logged, 0)
+                FROM subscribers s
+                LEFT JOIN (
+                    SELECT user_id, COUNT(*) AS logged FROM quest_completions
+                    WHERE NOT rolled_up
+                    GROUP BY user_id
+                ) c ON c.user_id = s.user_id
+            """)
+            async with self._completions_lock:
+                async with self.engine.connect() as conn:
+                    result = await conn.execute(query)
+                    rows = result.fetchall()
+                buffered = Counter(user_id for user_id, completed_at in self._pending_completions)
+                self.leaderboard.load((user_id, first_name, username, count + buffered[user_id])
+                                      for user_id, first_name, username, count in rows)
+            for user_id, (first_name, last_name, username) in self._dirty_profiles.items():
+                self.leaderboard.set_profile(user_id, first_name, username)
+            return True
+        except Exception as e:
+            logger.error(f"Error loading leaderboard: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def get_rank(self, user_id: int) -> Optional[int]:
+        """Get a user's 1-based leaderboard position, or None if they're not on it."""
+        if self.leaderboard.loaded:
+            return self.leaderboard.rank(user_id)
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot get rank")
+            return None
+        try:
+            query = text("""
+                SELECT 1 + (
+                    SELECT COUNT(*) FROM subscribers s
+                    WHERE COALESCE(s.quests_completed, 0) > COALESCE(me.quests_completed, 0)
+                    OR (COALESCE(s.quests_completed, 0) = COALESCE(me.quests_completed, 0) AND s.user_id < me.user_id)
+                )
+                FROM subscribers me
+                WHERE me.user_id = :user_id
+            """)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"user_id": user_id})
+                return result.scalar()
+        except Exception as e:
+            logger.error(f"Error getting rank for {user_id}: {e}")
+            logger.error(traceback.format_exc())
+            return None
+
+    async def set_mood(self, user_id: int, mood: str) -> bool:
         """Set the mood for a user."""
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot set mood")
@@ -199,52 +691,74 @@ class QuestBotDB:
             query = text("""
                 UPDATE subscribers SET mood = :mood WHERE user_id = :user_id
             """)
-            with self.engine.connect() as conn:
-                conn.execute(query, {"user_id": user_id, "mood": mood})
-                conn.commit()
+            async with self.engine.connect() as conn:
+                await conn.execute(query, {"user_id": user_id, "mood": mood})
+                await conn.commit()
+            self._mood_cache.invalidate(user_id)
             return True
         except Exception as e:
             logger.error(f"Error setting mood for {user_id}: {e}")
             logger.error(traceback.format_exc())
             return False
 
-    def get_mood(self, user_id: int) -> str:
+    async def get_mood(self, user_id: int) -> str:
         """Get the mood for a user. Returns None if not set."""
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot get mood")
             return None
+        mood = self._mood_cache.get(user_id)
+        if mood is not MISSING:
+            return mood
         try:
             query = text("SELECT mood FROM subscribers WHERE user_id = :user_id")
-            with self.engine.connect() as conn:
-                result = conn.execute(query, {"user_id": user_id})
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"user_id": user_id})
                 row = result.fetchone()
-                return row[0] if row and row[0] else None
+                mood = row[0] if row and row[0] else None
+            self._mood_cache.set(user_id, mood)
+            return mood
         except Exception as e:
             logger.error(f"Error getting mood for {user_id}: {e}")
             logger.error(traceback.format_exc())
             return None
 
-    def remove_subscriber(self, user_id: int) -> bool:
+    async def remove_subscriber(self, user_id: int) -> bool:
         """Remove a subscriber."""
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot remove subscriber")
             return False
-            
+        self._profiles.pop(user_id, None)
+        self._dirty_profiles.pop(user_id, None)
+        self.leaderboard.remove(user_id)
+        self.schedule.remove(user_id)
+
         try:
             query = text("""
                 DELETE FROM subscribers
                 WHERE user_id = :user_id
             """)
-            
-            with self.engine.connect() as conn:
-                conn.execute(query, {"user_id": user_id})
-                conn.commit()
+            # Their logged completions stay for the history but are never rolled up
+            retire_completions = text("""
+                UPDATE quest_completions SET rolled_up = TRUE
+                WHERE user_id = :user_id AND NOT rolled_up
+            """)
+
+            # Under the lock a flush can't write this user's buffered completions mid-removal
+            async with self._completions_lock:
+                self._pending_completions = [
+                    event for event in self._pending_completions if event[0] != user_id
+                ]
+                async with self.engine.connect() as conn:
+                    await conn.execute(query, {"user_id": user_id})
+                    await conn.execute(retire_completions, {"user_id": user_id})
+                    await conn.commit()
+            self._invalidate_state(user_id)
             return True
         except Exception as e:
             logger.error(f"Error removing subscriber {user_id}: {e}")
             return False
 
-    def get_all_subscribers(self) -> List[int]:
+    async def get_all_subscribers(self) -> List[int]:
         """Get all subscriber user IDs."""
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot fetch subscribers")
@@ -252,19 +766,317 @@ class QuestBotDB:
             
         try:
             query = text("SELECT user_id FROM subscribers")
-            with self.engine.connect() as conn:
-                result = conn.execute(query)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query)
                 return [row[0] for row in result]
         except Exception as e:
             logger.error(f"Error fetching subscribers: {e}")
             return []
 
-    def is_subscribed(self, user_id: int) -> bool:
-        """Check if a user is subscribed."""
+    async def iter_roster(self, delivery_date: date = None, user_ids: List[int] = None,
+                          batch_size: int = ROSTER_BATCH_SIZE) -> AsyncIterator[Tuple[int, Optional[str], Optional[str]]]:
+        """Stream (user_id, mood, queued_message) for every subscriber in a single query.
+
+        Rows come from a server-side cursor, batch_size at a time, so memory stays flat no matter
+        how many subscribers there are. queued_message is the pre-generated message for
+        delivery_date, or None if there isn't one (or no delivery_date was given). Pass
+        user_ids to restrict the roster to those subscribers.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot stream roster")
+            return
+        try:
+            query = text(f"""
+                SELECT s.user_id, s.mood, q.message
+                FROM subscribers s
+                LEFT JOIN delivery_queue q
+                    ON q.user_id = s.user_id AND q.delivery_date = :delivery_date
+                {"WHERE s.user_id = ANY(:user_ids)" if user_ids is not None else ""}
+                ORDER BY s.user_id
+            """).execution_options(yield_per=batch_size)
+            params = {"delivery_date": delivery_date}
+            if user_ids is not None:
+                params["user_ids"] = list(user_ids)
+            async with self.engine.connect() as conn:
+                result = await conn.stream(query, params)
+                async for partition in result.partitions():
+                    for row in partition:
+                        yield row[0], row[1], row[2]
+        except Exception as e:
+            logger.error(f"Error streaming roster: {e}")
+            logger.error(traceback.format_exc())
+
+    async def iter_chunk_roster(self, slot: datetime, shard: int, shards: int,
+                                batch_size: int = ROSTER_BATCH_SIZE
+                                ) -> AsyncIterator[Tuple[date, int, Optional[str], Optional[str]]]:
+        """Stream (delivery_date, user_id, mood, queued_message) for one delivery chunk.
+
+        The chunk is every subscriber with user_id % shards == shard whose stored
+        delivery_utc_minute is the UTC minute starting at slot, read through its index, so
+        changes made by other processes are included without scanning every subscriber.
+        Anyone the ledger already has as sent for their local date is skipped. Errors are
+        logged and re-raised, so a chunk is never taken as delivered because its roster
+        couldn't be read.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot stream chunk roster")
+            return
+        try:
+            query = text("""
+                WITH due AS (
+                    SELECT user_id, mood,
+                           CAST(CAST(:slot AS TIMESTAMP) + delivery_utc_offset * INTERVAL '1 minute' AS DATE)
+                               AS delivery_date
+                    FROM subscribers
+                    WHERE delivery_utc_minute = :minute AND user_id % :shards = :shard
+                )
+                SELECT d.delivery_date, d.user_id, d.mood, q.message
+                FROM due d
+                LEFT JOIN delivery_queue q
+                    ON q.user_id = d.user_id AND q.delivery_date = d.delivery_date
+                WHERE q.status IS NULL OR q.status <> 'sent'
+                ORDER BY d.user_id
+            """).execution_options(yield_per=batch_size)
+            utc_slot = _utc_naive(slot)
+            async with self.engine.connect() as conn:
+                result = await conn.stream(query, {
+                    "slot": utc_slot,
+                    "minute": utc_slot.hour * 60 + utc_slot.minute,
+                    "shard": shard,
+                    "shards": shards
+                })
+                async for partition in result.partitions():
+                    for row in partition:
+                        yield row[0], row[1], row[2], row[3]
+        except Exception as e:
+            logger.error(f"Error streaming roster for delivery chunk {slot}/{shard}: {e}")
+            logger.error(traceback.format_exc())
+            raise
+
+    async def refresh_delivery_slots(self) -> int:
+        """Recompute every subscriber's stored UTC delivery minute. Returns the number of rows changed.
+
+        A subscriber's UTC minute moves when their timezone changes to or from daylight
+        saving time, and rows written without going through add_subscriber or
+        set_delivery_time have none yet, so this runs with every schedule refresh. Only rows
+        whose values change are written.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot refresh delivery slots")
+            return 0
+        try:
+            query = text(_DELIVERY_SLOT_UPDATE.format(where="TRUE"))
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, _delivery_slot_params())
+                await conn.commit()
+            if result.rowcount:
+                logger.info(f"Moved {result.rowcount} subscribers to a new UTC delivery minute.")
+            return result.rowcount
+        except Exception as e:
+            logger.error(f"Error refreshing delivery slots: {e}")
+            logger.error(traceback.format_exc())
+            return 0
+
+    async def load_schedule(self) -> bool:
+        """Load every subscriber's timezone and delivery time into the in-memory schedule."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot load delivery schedule")
+            return False
+        try:
+            query = text("SELECT user_id, timezone, delivery_minute FROM subscribers").execution_options(
+                yield_per=ROSTER_BATCH_SIZE)
+            rows = []
+            async with self.engine.connect() as conn:
+                result = await conn.stream(query)
+                async for partition in result.partitions():
+                    rows.extend(partition)
+            self.schedule.load(rows)
+            return True
+        except Exception as e:
+            logger.error(f"Error loading delivery schedule: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def create_delivery_chunks(self, slots: List[datetime], shards: int) -> bool:
+        """Create the pending (slot, shard) delivery chunks for the given UTC minutes. Existing chunks are kept."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot create delivery chunks")
+            return False
+        if not slots:
+            return True
+        try:
+            query = text("""
+                INSERT INTO delivery_leases (slot, shard)
+                VALUES (:slot, :shard)
+                ON CONFLICT (slot, shard) DO NOTHING
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query, [
+                    {"slot": _utc_naive(slot), "shard": shard} for slot in slots for shard in range(shards)
+                ])
+                await conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error creating delivery chunks: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def claim_delivery_chunk(self, owner: str, since: datetime,
+                                   lease_seconds: int) -> Optional[Tuple[datetime, int]]:
+        """Lease the oldest unclaimed (or expired) delivery chunk at or after since.
+
+        Returns (slot, shard), or None if there's nothing left to claim. SKIP LOCKED lets
+        any number of processes claim chunks concurrently without handing one out twice.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot claim delivery chunk")
+            return None
+        try:
+            query = text("""
+                UPDATE delivery_leases
+                SET status = 'claimed',
+                    owner = :owner,
+                    lease_expires_at = (now() AT TIME ZONE 'utc') + make_interval(secs => :lease_seconds),
+                    attempts = attempts + 1
+                WHERE (slot, shard) = (
+                    SELECT slot, shard FROM delivery_leases
+                    WHERE slot >= :since
+                    AND slot <= (now() AT TIME ZONE 'utc')
+                    AND (status = 'pending'
+                         OR (status = 'claimed' AND lease_expires_at < (now() AT TIME ZONE 'utc')))
+                    ORDER BY slot, shard
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING slot, shard, attempts
+            """)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {
+                    "owner": owner,
+                    "since": _utc_naive(since),
+                    "lease_seconds": lease_seconds
+                })
+                row = result.fetchone()
+                await conn.commit()
+            if row is None:
+                return None
+            if row[2] > 1:
+                logger.warning(f"Reclaimed expired delivery chunk {row[0]}/{row[1]} (attempt {row[2]})")
+            return row[0].replace(tzinfo=timezone.utc), row[1]
+        except Exception as e:
+            logger.error(f"Error claiming delivery chunk: {e}")
+            logger.error(traceback.format_exc())
+            return None
+
+    async def renew_delivery_lease(self, slot: datetime, shard: int, owner: str, lease_seconds: int) -> Optional[bool]:
+        """Extend our lease on a chunk.
+
+        Returns True if it was renewed, False if the lease was lost to another process, and
+        None if the database couldn't be reached, in which case the lease may well still be ours.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot renew delivery lease")
+            return None
+        try:
+            query = text("""
+                UPDATE delivery_leases
+                SET lease_expires_at = (now() AT TIME ZONE 'utc') + make_interval(secs => :lease_seconds)
+                WHERE slot = :slot AND shard = :shard AND owner = :owner AND status = 'claimed'
+            """)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {
+                    "slot": _utc_naive(slot),
+                    "shard": shard,
+                    "owner": owner,
+                    "lease_seconds": lease_seconds
+                })
+                await conn.commit()
+            return result.rowcount == 1
+        except Exception as e:
+            logger.error(f"Error renewing delivery lease {slot}/{shard}: {e}")
+            return None
+
+    async def complete_delivery_chunk(self, slot: datetime, shard: int, owner: str) -> bool:
+        """Mark a chunk we own as delivered."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot complete delivery chunk")
+            return False
+        try:
+            query = text("""
+                UPDATE delivery_leases
+                SET status = 'done', lease_expires_at = NULL
+                WHERE slot = :slot AND shard = :shard AND owner = :owner
+            """)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"slot": _utc_naive(slot), "shard": shard, "owner": owner})
+                await conn.commit()
+            return result.rowcount == 1
+        except Exception as e:
+            logger.error(f"Error completing delivery chunk {slot}/{shard}: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def purge_delivery_leases(self, before: datetime) -> bool:
+        """Delete delivery chunks for slots older than before."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot purge delivery leases")
+            return False
+        try:
+            query = text("DELETE FROM delivery_leases WHERE slot < :before")
+            async with self.engine.connect() as conn:
+                await conn.execute(query, {"before": _utc_naive(before)})
+                await conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error purging delivery leases before {before}: {e}")
+            return False
+
+    async def set_delivery_time(self, user_id: int, timezone: str = None, delivery_minute: int = None) -> bool:
+        """Set a subscriber's timezone and/or local delivery time (minutes after midnight). None keeps the current value."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot set delivery time")
+            return False
+        try:
+            query = text("""
+                UPDATE subscribers
+                SET timezone = COALESCE(:timezone, timezone),
+                    delivery_minute = COALESCE(:delivery_minute, delivery_minute)
+                WHERE user_id = :user_id
+                RETURNING timezone, delivery_minute
+            """)
+            slot = text(_DELIVERY_SLOT_UPDATE.format(where="s.user_id = :user_id"))
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {
+                    "user_id": user_id,
+                    "timezone": timezone,
+                    "delivery_minute": delivery_minute
+                })
+                row = result.fetchone()
+                await conn.execute(slot, {"user_id": user_id, **_delivery_slot_params()})
+                await conn.commit()
+            if row is None:
+                return False
+            if self.schedule.loaded:
+                self.schedule.add(user_id, row[0], row[1])
+            return True
+        except Exception as e:
+            logger.error(f"Error setting delivery time for {user_id}: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def is_subscribed(self, user_id: int, cached: bool = True) -> bool:
+        """Check if a user is subscribed.
+
+        Pass cached=False where the answer decides a write: another replica may have changed
+        the subscription since this one cached it.
+        """
         if not hasattr(self, 'engine') or not self.engine:
             logger.warning("No database connection - cannot check subscription")
             return False
-            
+        subscribed = self._subscribed_cache.get(user_id) if cached else MISSING
+        if subscribed is not MISSING:
+            return subscribed
+
         try:
             query = text("""
                 SELECT EXISTS(
@@ -272,9 +1084,220 @@ class QuestBotDB:
                 )
             """)
             
-            with self.engine.connect() as conn:
-                result = conn.execute(query, {"user_id": user_id})
-                return result.scalar()
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"user_id": user_id})
+                subscribed = result.scalar()
+            self._subscribed_cache.set(user_id, subscribed)
+            return subscribed
         except Exception as e:
             logger.error(f"Error checking subscription for {user_id}: {e}")
-            return False 
\ No newline at end of file
+            return False 
+
+    def _invalidate_state(self, user_id: int):
+        self._mood_cache.invalidate(user_id)
+        self._subscribed_cache.invalidate(user_id)
+
+    def cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """Hit/miss counters for the mood and subscription caches."""
+        return {"mood": self._mood_cache.stats(), "subscribed": self._subscribed_cache.stats()}
+
+    async def enqueue_daily_messages(self, delivery_date: date, messages: Dict[int, str]) -> bool:
+        """Store pre-generated messages for delivery_date. Existing rows are kept."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot enqueue daily messages")
+            return False
+        if not messages:
+            return True
+        try:
+            query = text("""
+                INSERT INTO delivery_queue (delivery_date, user_id, message)
+                VALUES (:delivery_date, :user_id, :message)
+                ON CONFLICT (delivery_date, user_id) DO NOTHING
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query, [
+                    {"delivery_date": delivery_date, "user_id": user_id, "message": message}
+                    for user_id, message in messages.items()
+                ])
+                await conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error enqueueing daily messages for {delivery_date}: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def mark_delivered(self, deliveries: List[Tuple[date, int, str]]) -> bool:
+        """Record (delivery_date, user_id, message) deliveries as sent in the delivery ledger.
+
+        Messages generated on the fly get a ledger row here; pre-generated ones are updated.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot record deliveries")
+            return False
+        if not deliveries:
+            return True
+        try:
+            query = text("""
+                INSERT INTO delivery_queue (delivery_date, user_id, message, status, sent_at)
+                VALUES (:delivery_date, :user_id, :message, 'sent', now() AT TIME ZONE 'utc')
+                ON CONFLICT (delivery_date, user_id)
+                DO UPDATE SET status = 'sent', sent_at = EXCLUDED.sent_at
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query, [
+                    {"delivery_date": delivery_date, "user_id": user_id, "message": message}
+                    for delivery_date, user_id, message in deliveries
+                ])
+                await conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error recording {len(deliveries)} deliveries: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def get_daily_message(self, message_date: date) -> Optional[str]:
+        """Get the stored /today message for message_date, or None if there isn't one yet."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot fetch daily message")
+            return None
+        try:
+            query = text("SELECT message FROM daily_messages WHERE message_date = :message_date")
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"message_date": message_date})
+                return result.scalar()
+        except Exception as e:
+            logger.error(f"Error fetching daily message for {message_date}: {e}")
+            logger.error(traceback.format_exc())
+            return None
+
+    async def save_daily_message(self, message_date: date, message: str) -> str:
+        """Store the /today message for message_date unless another process got there first.
+
+        Returns the message that ended up stored, so every process serves the same one.
+        """
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot save daily message")
+            return message
+        try:
+            query = text("""
+                INSERT INTO daily_messages (message_date, message)
+                VALUES (:message_date, :message)
+                ON CONFLICT (message_date) DO NOTHING
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query, {"message_date": message_date, "message": message})
+                await conn.commit()
+                result = await conn.execute(
+                    text("SELECT message FROM daily_messages WHERE message_date = :message_date"),
+                    {"message_date": message_date}
+                )
+                return result.scalar() or message
+        except Exception as e:
+            logger.error(f"Error saving daily message for {message_date}: {e}")
+            logger.error(traceback.format_exc())
+            return message
+
+    async def load_quest_library(self) -> List[Tuple[int, str, str]]:
+        """Every (id, mood, message) in the quest library, oldest first."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot load quest library")
+            return []
+        try:
+            query = text("SELECT id, mood, message FROM quest_library ORDER BY id").execution_options(
+                yield_per=ROSTER_BATCH_SIZE)
+            rows = []
+            async with self.engine.connect() as conn:
+                result = await conn.stream(query)
+                async for partition in result.partitions():
+                    rows.extend((row[0], row[1], row[2]) for row in partition)
+            return rows
+        except Exception as e:
+            logger.error(f"Error loading quest library: {e}")
+            logger.error(traceback.format_exc())
+            return []
+
+    async def add_library_quests(self, mood: str, messages: List[str]) -> List[Tuple[int, str]]:
+        """Add generated quests for mood to the library. Returns their (id, message) rows."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot add library quests")
+            return []
+        if not messages:
+            return []
+        try:
+            query = text("""
+                INSERT INTO quest_library (mood, message)
+                SELECT :mood, unnest(CAST(:messages AS TEXT[]))
+                RETURNING id, message
+            """)
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"mood": mood, "messages": list(messages)})
+                rows = [(row[0], row[1]) for row in result]
+                await conn.commit()
+            return rows
+        except Exception as e:
+            logger.error(f"Error adding {len(messages)} library quests for {mood}: {e}")
+            logger.error(traceback.format_exc())
+            return []
+
+    async def get_seen_quests(self, user_ids: List[int]) -> Dict[int, bytes]:
+        """The seen-quest bitmaps for user_ids. Users who haven't seen anything are left out."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot fetch seen quests")
+            return {}
+        if not user_ids:
+            return {}
+        try:
+            query = text("SELECT user_id, seen FROM quest_seen WHERE user_id = ANY(:user_ids)")
+            async with self.engine.connect() as conn:
+                result = await conn.execute(query, {"user_ids": list(user_ids)})
+                return {row[0]: bytes(row[1]) for row in result}
+        except Exception as e:
+            logger.error(f"Error fetching seen quests: {e}")
+            logger.error(traceback.format_exc())
+            return {}
+
+    async def mark_quests_seen(self, seen: List[Tuple[int, int]]) -> bool:
+        """Set the bits for (user_id, quest_id) pairs in the users' seen bitmaps, growing them as needed."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot mark quests seen")
+            return False
+        if not seen:
+            return True
+        try:
+            # set_bit numbers bits from the low end of each byte, matching QuestLibrary
+            query = text("""
+                INSERT INTO quest_seen (user_id, seen)
+                VALUES (:user_id, set_bit(decode(repeat('00', CAST(:quest_id AS INTEGER) / 8 + 1), 'hex'), :quest_id, 1))
+                ON CONFLICT (user_id) DO UPDATE SET seen = set_bit(
+                    CASE WHEN length(quest_seen.seen) > CAST(:quest_id AS INTEGER) / 8 THEN quest_seen.seen
+                         ELSE quest_seen.seen || decode(repeat('00', CAST(:quest_id AS INTEGER) / 8 + 1 - length(quest_seen.seen)), 'hex')
+                    END, :quest_id, 1)
+            """)
+            async with self.engine.connect() as conn:
+                await conn.execute(query, [{"user_id": user_id, "quest_id": quest_id} for user_id, quest_id in seen])
+                await conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error marking {len(seen)} quests seen: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def purge_queued_messages(self, before_date: date) -> bool:
+        """Delete queued messages older than before_date."""
+        if not hasattr(self, 'engine') or not self.engine:
+            logger.warning("No database connection - cannot purge queued messages")
+            return False
+        try:
+            query = text("DELETE FROM delivery_queue WHERE delivery_date < :before_date")
+            async with self.engine.connect() as conn:
+                await conn.execute(query, {"before_date": before_date})
+                await conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error purging queued messages before {before_date}: {e}")
+            return False
+
+    async def close(self):
+        """Dispose of the async engine's connection pool."""
+        if hasattr(self, 'engine') and self.engine:
+            await self.engine.dispose()
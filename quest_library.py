@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+import random
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from quest_templates import generate_slip, is_template
+
+logger = logging.getLogger(__name__)
+
+# Top a mood up once a user has this few unseen quests left in it, by this many quests
+QUEST_LIBRARY_LOW_WATER = int(os.getenv('QUEST_LIBRARY_LOW_WATER', '3'))
+QUEST_LIBRARY_REFILL = int(os.getenv('QUEST_LIBRARY_REFILL', '5'))
+# Seen-quest bitmaps kept in memory, and how often newly served quests are written back
+QUEST_SEEN_CACHE_SIZE = int(os.getenv('QUEST_SEEN_CACHE_SIZE', '10000'))
+QUEST_SEEN_FLUSH_INTERVAL = float(os.getenv('QUEST_SEEN_FLUSH_INTERVAL', '10'))
+
+
+class QuestLibrary:
+    """Generated permission slips kept per mood, served to each user at most once.
+
+    Every generated slip goes into the quest_library table, and each user has a bitmap of
+    the library ids they've been served. A request takes a random slip the user hasn't seen,
+    so the model is only called when a user runs low on unseen slips for their mood. Served
+    slips are marked in memory right away and written to the database in batches.
+    """
+
+    def __init__(self, ai, db, refill: int = QUEST_LIBRARY_REFILL, low_water: int = QUEST_LIBRARY_LOW_WATER,
+                 seen_cache_size: int = QUEST_SEEN_CACHE_SIZE):
+        self.ai = ai
+        self.db = db
+        self.refill = refill
+        self.low_water = low_water
+        self.seen_cache_size = seen_cache_size
+        self.hits = 0
+        self.generated = 0
+        self._quests: Dict[str, List[Tuple[int, str]]] = {}
+        self._seen: OrderedDict = OrderedDict()
+        self._pending_seen: Dict[int, Set[int]] = {}
+        self._refills: Dict[str, asyncio.Task] = {}
+
+    def _connected(self) -> bool:
+        return self.db is not None and bool(getattr(self.db, 'engine', None))
+
+    async def load(self):
+        """Load the whole library from the database."""
+        self._quests = {}
+        for quest_id, mood, message in await self.db.load_quest_library():
+            self._quests.setdefault(mood, []).append((quest_id, message))
+        logger.info(f"Quest library loaded: {len(self)} quests for {len(self._quests)} moods")
+
+    def _remember_seen(self, user_id: int, seen: bytearray):
+        self._seen[user_id] = seen
+        self._seen.move_to_end(user_id)
+        while len(self._seen) > self.seen_cache_size:
+            self._seen.popitem(last=False)
+
+    async def prefetch_seen(self, user_ids: List[int]):
+        """Load the seen bitmaps for many users in one query, e.g. ahead of a broadcast batch."""
+        missing = [user_id for user_id in user_ids if user_id not in self._seen]
+        stored = await self.db.get_seen_quests(missing)
+        for user_id in missing:
+            seen = bytearray(stored.get(user_id, b''))
+            # Quests served since the last flush aren't in the database yet
+            for quest_id in self._pending_seen.get(user_id, ()):
+                _set_bit(seen, quest_id)
+            self._remember_seen(user_id, seen)
+
+    async def _get_seen(self, user_id: int) -> bytearray:
+        if user_id not in self._seen:
+            await self.prefetch_seen([user_id])
+        self._seen.move_to_end(user_id)
+        return self._seen[user_id]
+
+    async def _refill(self, mood: str):
+        slips = await self.ai.generate_permission_slips(mood, self.refill)
+        # Template fallbacks from a failed generation aren't worth keeping
+        slips = [slip for slip in slips if not is_template(slip)]
+        rows = await self.db.add_library_quests(mood, slips)
+        self._quests.setdefault(mood, []).extend(rows)
+        self.generated += len(rows)
+        logger.info(f"Added {len(rows)} quests to the {mood} library ({len(self._quests[mood])} total)")
+
+    def _start_refill(self, mood: str) -> asyncio.Task:
+        """Refill a mood, sharing one refill between everyone who asks while it runs."""
+        task = self._refills.get(mood)
+        if task is None:
+            task = asyncio.create_task(self._refill(mood))
+            self._refills[mood] = task
+            task.add_done_callback(lambda _: self._refills.pop(mood, None))
+        return task
+
+    def _serve(self, user_id: int, seen: bytearray, quest: Tuple[int, str]) -> str:
+        quest_id, message = quest
+        _set_bit(seen, quest_id)
+        self._pending_seen.setdefault(user_id, set()).add(quest_id)
+        return message
+
+    async def take_unseen(self, user_id: int, mood: str) -> Optional[str]:
+        """A slip for mood that user_id hasn't been served yet, or None if they've seen them all.
+
+        Starts a refill in the background when the user is running low. Without a database
+        nothing could be stored, so there is no library and this is always None.
+        """
+        if not self._connected():
+            return None
+        seen = await self._get_seen(user_id)
+        unseen = [quest for quest in self._quests.get(mood, ()) if not _get_bit(seen, quest[0])]
+        if len(unseen) <= self.low_water:
+            self._start_refill(mood)
+        if not unseen:
+            return None
+        self.hits += 1
+        return self._serve(user_id, seen, random.choice(unseen))
+
+    async def next_slip(self, user_id: int, mood: str) -> str:
+        """A slip for mood that user_id hasn't been served yet, waiting for a refill if they've seen them all."""
+        message = await self.take_unseen(user_id, mood)
+        if message is not None:
+            return message
+        task = self._refills.get(mood)
+        if task is not None:
+            await asyncio.shield(task)
+        message = await self.take_unseen(user_id, mood)
+        # Generation failed and the user has seen everything we have
+        return message if message is not None else generate_slip(mood)
+
+    async def add_served(self, user_id: int, mood: str, message: str):
+        """Store a slip generated directly for user_id in the library, marked as seen by them."""
+        if is_template(message) or not self._connected():
+            return
+        rows = await self.db.add_library_quests(mood, [message])
+        self._quests.setdefault(mood, []).extend(rows)
+        self.generated += len(rows)
+        seen = await self._get_seen(user_id)
+        for quest in rows:
+            self._serve(user_id, seen, quest)
+
+    def cached_slip(self, mood: str) -> Optional[str]:
+        """Any library slip for mood, without touching the database or the model."""
+        quests = self._quests.get(mood)
+        return random.choice(quests)[1] if quests else None
+
+    async def flush_seen(self) -> bool:
+        """Write the quests served since the last flush to the users' seen bitmaps."""
+        if not self._pending_seen:
+            return True
+        pending, self._pending_seen = self._pending_seen, {}
+        if await self.db.mark_quests_seen([(user_id, quest_id) for user_id, quest_ids in pending.items()
+                                           for quest_id in quest_ids]):
+            return True
+        # Keep them for the next flush
+        for user_id, quest_ids in pending.items():
+            self._pending_seen.setdefault(user_id, set()).update(quest_ids)
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        return {"quests": len(self), "moods": len(self._quests), "hits": self.hits, "generated": self.generated}
+
+    def __len__(self):
+        return sum(len(quests) for quests in self._quests.values())
+
+
+def _get_bit(bitmap: bytearray, bit: int) -> bool:
+    index = bit // 8
+    return index < len(bitmap) and bool(bitmap[index] >> (bit % 8) & 1)
+
+
+def _set_bit(bitmap: bytearray, bit: int):
+    index = bit // 8
+    if index >= len(bitmap):
+        bitmap.extend(bytes(index + 1 - len(bitmap)))
+    bitmap[index] |= 1 << (bit % 8)
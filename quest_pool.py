@@ -0,0 +1,40 @@
+import asyncio
+import itertools
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of distinct permission slips generated per mood for a broadcast
+QUEST_POOL_VARIANTS = int(os.getenv('QUEST_POOL_VARIANTS', '5'))
+
+
+class QuestPool:
+    """A small pool of permission slips per mood, handed out round-robin.
+
+    Subscribers sharing a mood get the same prompt, so instead of one completion per
+    subscriber the pool makes one multi-choice completion per mood bucket.
+    """
+
+    def __init__(self, ai, variants: int = QUEST_POOL_VARIANTS):
+        self.ai = ai
+        self.variants = variants
+        self._slips = {}
+        self._cycles = {}
+        self._locks = {}
+
+    async def _build_mood(self, mood: str, n: int):
+        slips = await self.ai.generate_permission_slips(mood, n)
+        self._slips[mood] = slips
+        self._cycles[mood] = itertools.cycle(slips)
+
+    async def next_slip(self, mood: str) -> str:
+        """Return the next slip for `mood`, pooling `variants` slips on first use of a mood."""
+        if mood not in self._cycles:
+            async with self._locks.setdefault(mood, asyncio.Lock()):
+                if mood not in self._cycles:
+                    await self._build_mood(mood, self.variants)
+        return next(self._cycles[mood])
+
+    def __len__(self):
+        return sum(len(slips) for slips in self._slips.values())
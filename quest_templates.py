@@ -0,0 +1,167 @@
+import random
+from typing import Dict, List, Optional
+
+# Slip layout, matching what the permission slip prompt asks the model for
+SLIP_FORMAT = "✨ {title} ✨\n\n{affirmation}\n\n{quest_title}\n{quest}\n\n{encouragement}"
+
+SPARKLES = ["✨", "🌟", "💫", "🌈", "🔥", "🌻", "🦋", "🌊", "🍀", "🌙", "☀️", "💖"]
+
+# Fills for the {slot}s in the quest fragments below, shared by every mood
+SLOTS = {
+    "minutes": ["two", "three", "five", "ten"],
+    "object": ["your favorite mug", "a houseplant", "your left shoe", "a window", "a book on your shelf",
+               "the nearest tree", "a pillow", "a cloud", "a spoon", "your keychain"],
+    "place": ["by a window", "on your doorstep", "in the nearest park", "at your desk", "in the kitchen",
+              "on a bench", "on your balcony", "in a quiet corner"],
+    "person": ["a friend you haven't talked to in a while", "a family member", "a coworker",
+               "a neighbor", "someone who made you laugh recently", "an old teacher"],
+    "sense": ["sounds", "colors", "textures", "smells", "shapes"],
+    "count": ["three", "five", "seven"],
+    "medium": ["a pen", "some crayons", "your phone camera", "a sticky note", "a napkin and a pencil"],
+}
+
+GRAMMARS: Dict[str, Dict[str, List[str]]] = {
+    "Creative": {
+        "titles": ["The Doodle Portal", "Tiny Masterpiece Hour", "Color Outside the Lines",
+                   "The Imagination Workshop", "Sketchbook of Wonder", "Make Something Weird"],
+        "affirmations": ["YOUR IMAGINATION IS A WILD, BEAUTIFUL SUPERPOWER!",
+                         "EVERY IDEA YOU HAVE IS A SEED OF SOMETHING MAGICAL!",
+                         "YOU DON'T NEED PERMISSION TO CREATE, BUT HERE IT IS ANYWAY!",
+                         "THE WORLD IS BRIGHTER WHEN YOU MAKE THINGS!",
+                         "YOUR WEIRDEST IDEAS ARE YOUR BEST IDEAS!",
+                         "YOU ARE AN ARTIST SIMPLY BECAUSE YOU NOTICE!"],
+        "quest_titles": ["🎨 Today's Creative Quest", "🖍️ Tiny Art Adventure", "📸 Creative Spark Quest"],
+        "quests": ["Grab {medium} and spend {minutes} minutes drawing {object} exactly as it looks to you right now.",
+                   "Write a six-word story about {object}, then read it out loud like it's a movie trailer.",
+                   "Take {count} photos of {sense} you'd normally walk past {place}, and pick a favorite.",
+                   "Use {medium} to make a tiny thank-you card for {person}, no skill required.",
+                   "Invent a name and a backstory for {object} and tell it to someone (or your reflection)."],
+    },
+    "Physical": {
+        "titles": ["The Wiggle Break", "Body Joy Moment", "Stretch Into Sunshine",
+                   "The Happy Feet Hour", "Move Like Nobody's Watching", "Tiny Adventure Steps"],
+        "affirmations": ["YOUR BODY IS A MARVELOUS VEHICLE FOR JOY!",
+                         "EVERY BREATH YOU TAKE FILLS YOU WITH FRESH ENERGY!",
+                         "YOU ARE STRONG IN WAYS YOU HAVEN'T EVEN DISCOVERED YET!",
+                         "MOVING YOUR BODY IS A LOVE LETTER TO YOURSELF!",
+                         "YOU DESERVE TO FEEL GOOD IN YOUR OWN SKIN!",
+                         "YOUR HEART IS DRUMMING A SONG OF POSSIBILITY!"],
+        "quest_titles": ["🏃 Today's Movement Quest", "🤸 Joyful Body Quest", "🚶 Little Legs Adventure"],
+        "quests": ["Spend {minutes} minutes stretching {place}, and notice which stretch feels the most delicious.",
+                   "Take a slow walk and count {count} different {sense} along the way.",
+                   "Put on one song you love and dance to the whole thing, even if it's just with your shoulders.",
+                   "Stand up, reach for the ceiling, and take {count} deep breaths as tall as you can be.",
+                   "Walk somewhere you can see {object}, pause for {count} slow breaths, and come back the long way."],
+    },
+    "Social": {
+        "titles": ["The Kindness Ripple", "Connection Spark", "The Compliment Quest",
+                   "Hello, Human!", "Warm Fuzzies Delivery", "The Tiny Reunion"],
+        "affirmations": ["YOUR KINDNESS CHANGES PEOPLE'S DAYS IN WAYS YOU'LL NEVER SEE!",
+                         "YOU ARE SOMEONE PEOPLE ARE LUCKY TO KNOW!",
+                         "YOUR VOICE MATTERS AND PEOPLE WANT TO HEAR IT!",
+                         "EVERY CONNECTION YOU MAKE WEAVES THE WORLD TIGHTER!",
+                         "YOU BRING A LIGHT INTO EVERY ROOM YOU ENTER!",
+                         "THE LOVE YOU GIVE COMES BACK MULTIPLIED!"],
+        "quest_titles": ["💌 Today's Connection Quest", "🤝 Kindness Mission", "💬 Little Hello Quest"],
+        "quests": ["Send a short message to {person} telling them one specific thing you appreciate about them.",
+                   "Give {count} genuine compliments today about something people chose, not how they look.",
+                   "Ask {person} what made them smile this week, and really listen to the answer.",
+                   "Leave a kind note {place} for whoever finds it next.",
+                   "Learn the name of someone you see often but have never really talked to."],
+    },
+    "Reflection": {
+        "titles": ["The Quiet Pause", "A Moment of Stillness", "The Gratitude Garden",
+                   "Breathing Room", "Pocket of Peace", "The Gentle Check-In"],
+        "affirmations": ["YOU ARE ALLOWED TO SLOW DOWN AND SIMPLY BE!",
+                         "YOUR FEELINGS ARE VALID, AND YOU ARE DOING BETTER THAN YOU THINK!",
+                         "THIS VERY MOMENT HOLDS EVERYTHING YOU NEED!",
+                         "YOU CARRY A DEEP, QUIET WISDOM INSIDE YOU!",
+                         "PEACE IS ALWAYS JUST ONE BREATH AWAY!",
+                         "YOU ARE ENOUGH, EXACTLY AS YOU ARE RIGHT NOW!"],
+        "quest_titles": ["🍃 Today's Gentle Quest", "🕯️ Mindful Moment Quest", "🌙 Quiet Heart Quest"],
+        "quests": ["Sit {place} for {minutes} minutes and name {count} {sense} you notice without judging them.",
+                   "Write down {count} small things that went right this week, however tiny.",
+                   "Look at {object} as if you'd never seen one before, and notice a detail you usually miss.",
+                   "Close your eyes, take {count} slow breaths, and ask yourself what you need today.",
+                   "Before bed, jot down one moment from today you want to remember."],
+    },
+}
+
+# Moods with their own prompt but no grammar of their own borrow these fragments
+BASE_MOODS = list(GRAMMARS)
+
+UNHINGED_AFFIRMATIONS = ["YOU ARE A GLITTER-POWERED CHAOS COMET OF GOODNESS!",
+                         "THE UNIVERSE ITSELF IS CHEERING YOU ON RIGHT NOW!",
+                         "YOU ARE 100% UNFILTERED MAGIC AND THE WORLD CAN'T HANDLE IT!",
+                         "RULES ARE SUGGESTIONS AND YOU ARE A SUPERNOVA!"]
+
+ENCOURAGEMENTS = ["Remember: tiny moments like this ripple out through your whole day. 💫",
+                  "Small steps count. This one is a gift to yourself. 🌟",
+                  "However it goes, you showed up for yourself today, and that's magic. ✨",
+                  "Notice how you feel afterwards; that feeling is yours to keep. 🌈",
+                  "The world is a little brighter every time you do something like this. ☀️"]
+
+
+class TemplateSlip(str):
+    """A permission slip made from templates rather than by the model."""
+
+
+def is_template(slip: str) -> bool:
+    """Whether a slip came from the template engine (and so shouldn't be stored as a generated quest)."""
+    return isinstance(slip, TemplateSlip)
+
+
+def _emojify(text: str, rng: random.Random) -> str:
+    """Scatter emojis between the words, for Unhinged Maximum."""
+    words = text.split(" ")
+    out = []
+    for word in words:
+        out.append(word)
+        if rng.random() < 0.6:
+            out.append(rng.choice(SPARKLES))
+    return " ".join(out)
+
+
+def _unhinge(text: str, emojify: bool, rng: random.Random) -> str:
+    lines = [line.upper() for line in text.split("\n")]
+    if emojify:
+        lines = [_emojify(line, rng) if line else line for line in lines]
+    return "\n".join(lines)
+
+
+def generate_slip(mood: Optional[str] = None, rng: Optional[random.Random] = None) -> TemplateSlip:
+    """Build a permission slip for mood from the template grammars, without calling the model."""
+    rng = rng or random
+    key = mood.strip().lower() if mood else ""
+    unhinged = key.startswith("unhinged")
+    grammar = next((g for name, g in GRAMMARS.items() if name.lower() == key), None)
+    if grammar is None:
+        grammar = GRAMMARS[rng.choice(BASE_MOODS)]
+
+    affirmation_pool = grammar["affirmations"] + (UNHINGED_AFFIRMATIONS if unhinged else [])
+    affirmation = "\n".join(f"{line} {rng.choice(SPARKLES)}" for line in rng.sample(affirmation_pool, 2))
+    quest = rng.choice(grammar["quests"]).format(**{slot: rng.choice(fills) for slot, fills in SLOTS.items()})
+    slip = SLIP_FORMAT.format(
+        title=rng.choice(grammar["titles"]).upper(),
+        affirmation=affirmation,
+        quest_title=rng.choice(grammar["quest_titles"]),
+        quest=quest,
+        encouragement=rng.choice(ENCOURAGEMENTS),
+    )
+    if unhinged:
+        slip = _unhinge(slip, key == "unhinged maximum", rng)
+    return TemplateSlip(slip)
+
+
+def generate_slips(mood: Optional[str] = None, n: int = 1) -> List[TemplateSlip]:
+    """n template slips for mood, distinct where the grammar allows."""
+    slips = []
+    seen = set()
+    for _ in range(n * 3):
+        slip = generate_slip(mood)
+        if slip not in seen:
+            seen.add(slip)
+            slips.append(slip)
+            if len(slips) == n:
+                break
+    return slips
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Updates handled at once across all users; each user's own updates still run one at a time
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently across users but in order for each user.
+
+    Conversation state (e.g. /setmood waiting for the mood button) is per user, so two
+    updates from the same user must not overlap: the second one would be matched against
+    the state from before the first was handled. Each user gets a lock that lives only
+    while they have updates in flight, and an update only takes one of the
+    `max_concurrent_updates` slots once it holds its user's lock, so one user's backlog can't
+    starve everyone else. Updates without a user run unserialized.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        # user_id -> (lock, updates holding or waiting for it)
+        self._locks: Dict[int, list] = {}
+
+    @staticmethod
+    def _user_id(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # PTB marks this final for type checkers, but the base class takes its concurrency slot
+        # here, and a user's queued updates must not hold slots while they wait for their turn
+        user_id = self._user_id(update)
+        if user_id is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass